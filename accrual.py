@@ -0,0 +1,226 @@
+import logging
+import math
+import sqlite3
+import time
+
+log = logging.getLogger("miningbot.accrual")
+
+# сколько пользователей обрабатываем в одной транзакции
+CHUNK_SIZE = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accrual_runs(
+    period TEXT PRIMARY KEY,
+    rate REAL,
+    last_id INTEGER DEFAULT 0,
+    rows INTEGER DEFAULT 0,
+    status TEXT DEFAULT 'running',
+    started_at INTEGER,
+    finished_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_users_ref_id ON users(ref_id);
+"""
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    c.commit()
+
+
+def current_period(now: int | None = None) -> str:
+    # один период начисления = одни сутки UTC
+    return time.strftime("%Y-%m-%d", time.gmtime(now if now is not None else time.time()))
+
+
+def _begin_run(c: sqlite3.Connection, period: str, rate: float, now: int):
+    c.execute("INSERT OR IGNORE INTO accrual_runs(period, rate, started_at) VALUES(?,?,?)", (period, rate, now))
+    return c.execute("SELECT rate, last_id, rows, status FROM accrual_runs WHERE period=?", (period,)).fetchone()
+
+
+def _accrue_chunk(c: sqlite3.Connection, period: str, rate: float, now: int, chunk_size: int):
+    # один чанк lo < id <= hi целиком в одной транзакции вместе с курсором прогона. Курсор читается здесь же,
+    # а не передаётся из вызывающего: два прогона одного периода (ручной и по расписанию) не начислят дважды
+    lo, status = c.execute("SELECT last_id, status FROM accrual_runs WHERE period=?", (period,)).fetchone()
+    if status == "done":
+        return None
+    row = c.execute("SELECT MAX(id) FROM (SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?)",
+                    (lo, chunk_size)).fetchone()
+    hi = row[0] if row else None
+    if hi is None:
+        c.execute("UPDATE accrual_runs SET status='done', finished_at=? WHERE period=?", (now, period))
+        return None
+    rng = (lo, hi)
+    # начислим пользователям
+    c.execute("INSERT INTO accruals(user_id, amount, created_at) "
+              "SELECT id, hashrate * ?, ? FROM users WHERE id > ? AND id <= ? AND hashrate > 0",
+              (rate, now, *rng))
+    n = c.execute("UPDATE users SET balance = balance + hashrate * ? WHERE id > ? AND id <= ? AND hashrate > 0",
+                  (rate, *rng)).rowcount
+    # рефералка по уровням из ref_levels: бонусы чанка агрегируются по предку одним проходом по ref_closure,
+    # затем одна запись в журнале, один UPDATE баланса и статистики на каждого получателя
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS ref_bonus(user_id INTEGER PRIMARY KEY, bonus REAL)")
+    c.execute("DELETE FROM temp.ref_bonus")
+    c.execute("INSERT INTO temp.ref_bonus(user_id, bonus) "
+              "SELECT cl.ancestor, SUM(u.hashrate * ? * l.pct) FROM users u "
+              "JOIN ref_closure cl ON cl.descendant = u.id JOIN ref_levels l ON l.depth = cl.depth "
+              "WHERE u.id > ? AND u.id <= ? AND u.hashrate > 0 GROUP BY cl.ancestor",
+              (rate, *rng))
+    c.execute("INSERT INTO accruals(user_id, amount, created_at) SELECT user_id, bonus, ? FROM temp.ref_bonus", (now,))
+    c.execute("UPDATE users SET balance = balance + b.bonus FROM temp.ref_bonus AS b WHERE users.id = b.user_id")
+    c.execute("UPDATE ref_stats SET bonus = ref_stats.bonus + b.bonus FROM temp.ref_bonus AS b "
+              "WHERE ref_stats.user_id = b.user_id")
+    c.execute("UPDATE accrual_runs SET last_id=?, rows=rows+? WHERE period=?", (hi, n, period))
+    return hi, n
+
+
+def run_accrual(tx, rate: float, period: str | None = None, chunk_size: int = CHUNK_SIZE) -> dict:
+    # tx(fn, *args) выполняет fn(con, *args) в отдельной транзакции и ждёт коммита (Storage.write_sync);
+    # блокирующая функция: вызывать из отдельного потока, не из event loop
+    now = int(time.time())
+    period = period or current_period(now)
+    started = time.perf_counter()
+    run_rate, last_id, rows, status = tx(_begin_run, period, rate, now)
+    stats = {"period": period, "rate": run_rate, "rows": 0, "resumed": last_id > 0, "already_done": status == "done"}
+    if status != "done":
+        # при возобновлении берём ставку, с которой период был начат
+        while True:
+            res = tx(_accrue_chunk, period, run_rate, now, chunk_size)
+            if res is None:
+                break
+            stats["rows"] += res[1]
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = elapsed
+    stats["rows_per_sec"] = stats["rows"] / elapsed if elapsed > 0 else 0.0
+    log.info("accrual %s: %d rows in %.2fs (%.0f rows/s)%s", period, stats["rows"], elapsed, stats["rows_per_sec"],
+             " [already done]" if stats["already_done"] else "")
+    return stats
+
+
+# --- Lazy mode: доход считается при чтении и фиксируется в balance только при записи ---
+SECONDS_PER_DAY = 86400
+
+LAZY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_segments(
+    started_at INTEGER PRIMARY KEY,
+    rate REAL,
+    acc_start REAL
+);
+CREATE TABLE IF NOT EXISTS hashrate_segments(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    hashrate REAL,
+    started_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_hashrate_segments_user ON hashrate_segments(user_id, started_at);
+"""
+# last_accrued_at — момент последней фиксации, acc_mark — значение индекса дохода в этот момент,
+# ref_hashrate — хешрейт потомков, взвешенный процентами уровней рефералки (для бонуса без обхода графа)
+LAZY_USER_COLUMNS = {"last_accrued_at": "INTEGER", "acc_mark": "REAL DEFAULT 0", "ref_hashrate": "REAL DEFAULT 0"}
+
+# текущий сегмент ставки (started_at, rate, acc_start), чтобы индекс считался без запроса
+_segment: tuple[int, float, float] | None = None
+
+
+def init_lazy_schema(c: sqlite3.Connection, rate: float):
+    c.executescript(LAZY_SCHEMA)
+    have = {r[1] for r in c.execute("PRAGMA table_info(users)")}
+    for col, decl in LAZY_USER_COLUMNS.items():
+        if col not in have:
+            c.execute(f"ALTER TABLE users ADD COLUMN {col} {decl}")
+    # кандидаты в топ баланса по скорости дохода (board.top_balances): крупный реферер со скромным своим хешрейтом
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_income_hashrate ON users(hashrate + ref_hashrate)")
+    if c.execute("SELECT 1 FROM rate_segments LIMIT 1").fetchone() is None:
+        c.execute("INSERT INTO rate_segments(started_at, rate, acc_start) VALUES(?,?,0)", (int(time.time()), rate))
+    c.commit()
+    _load_segment(c)
+
+
+def _load_segment(c: sqlite3.Connection):
+    global _segment
+    _segment = c.execute("SELECT started_at, rate, acc_start FROM rate_segments ORDER BY started_at DESC LIMIT 1").fetchone()
+
+
+def acc_index(now: float | None = None) -> float:
+    # накопленный доход на 1 GH/s: O(1) по текущему сегменту ставки
+    started_at, rate, acc_start = _segment
+    now = time.time() if now is None else now
+    return acc_start + rate * max(0.0, now - started_at) / SECONDS_PER_DAY
+
+
+def add_rate_segment(c: sqlite3.Connection, rate: float, now: int | None = None):
+    # смена ставки закрывает текущий сегмент: всё, что заработано до now, считается по старой ставке
+    if not (math.isfinite(rate) and rate >= 0):
+        raise ValueError(f"bad rate: {rate!r}")
+    now = int(time.time()) if now is None else now
+    _load_segment(c)
+    acc = acc_index(now)
+    c.execute("INSERT INTO rate_segments(started_at, rate, acc_start) VALUES(?,?,?) "
+              "ON CONFLICT(started_at) DO UPDATE SET rate=excluded.rate", (now, rate, acc))
+    _load_segment(c)
+
+
+def lazy_pending(hashrate: float, ref_hashrate: float, acc_mark: float, acc: float) -> tuple[float, float]:
+    d = acc - (acc_mark or 0.0)
+    if d <= 0:
+        return 0.0, 0.0
+    return (hashrate or 0.0) * d, (ref_hashrate or 0.0) * d
+
+
+def settle(c: sqlite3.Connection, uid: int, now: int | None = None) -> float:
+    # переносит накопленное в balance и журнал; коммитит вызывающий
+    now = int(time.time()) if now is None else now
+    row = c.execute("SELECT hashrate, ref_hashrate, acc_mark FROM users WHERE id=?", (uid,)).fetchone()
+    if not row:
+        return 0.0
+    acc = acc_index(now)
+    own, ref = lazy_pending(*row, acc)
+    c.execute("UPDATE users SET balance = balance + ? + ?, acc_mark=?, last_accrued_at=? WHERE id=?",
+              (own, ref, acc, now, uid))
+    if own > 0:
+        c.execute("INSERT INTO accruals(user_id, amount, created_at) VALUES(?,?,?)", (uid, own, now))
+    if ref > 0:
+        c.execute("INSERT INTO accruals(user_id, amount, created_at) VALUES(?,?,?)", (uid, ref, now))
+        c.execute("UPDATE ref_stats SET bonus = bonus + ? WHERE user_id=?", (ref, uid))
+    return own + ref
+
+
+def add_hashrate(c: sqlite3.Connection, uid: int, delta: float, lazy: bool, now: int | None = None):
+    # изменение хешрейта — граница сегмента: сначала фиксируем доход по старому хешрейту у юзера и всех предков,
+    # получающих с него бонус. ref_hashrate предков и статистику рефералки обновляет триггер ref_users_hashrate
+    now = int(time.time()) if now is None else now
+    if not c.execute("SELECT 1 FROM users WHERE id=?", (uid,)).fetchone():
+        return
+    if lazy:
+        settle(c, uid, now)
+        for (ancestor,) in c.execute("SELECT cl.ancestor FROM ref_closure cl JOIN ref_levels l ON l.depth = cl.depth "
+                                     "WHERE cl.descendant=?", (uid,)).fetchall():
+            settle(c, ancestor, now)
+    c.execute("UPDATE users SET hashrate = hashrate + ? WHERE id=?", (delta, uid))
+    c.execute("INSERT INTO hashrate_segments(user_id, hashrate, started_at) "
+              "SELECT id, hashrate, ? FROM users WHERE id=?", (now, uid))
+
+
+def recompute_ref_hashrate(c: sqlite3.Connection):
+    c.execute("UPDATE users SET ref_hashrate = COALESCE(("
+              " SELECT SUM(d.hashrate * l.pct) FROM ref_closure cl"
+              " JOIN ref_levels l ON l.depth = cl.depth JOIN users d ON d.id = cl.descendant"
+              " WHERE cl.ancestor = users.id AND d.hashrate > 0), 0)")
+
+
+def switch_mode(c: sqlite3.Connection, mode: str):
+    # разовый O(N) переход между режимами при старте, если режим сменился
+    row = c.execute("SELECT v FROM settings WHERE k='accrual_mode'").fetchone()
+    prev = row[0] if row else "batch"
+    if prev == mode:
+        return
+    now = int(time.time())
+    acc = acc_index(now)
+    if mode == "lazy":
+        recompute_ref_hashrate(c)
+        c.execute("UPDATE users SET acc_mark=?, last_accrued_at=?", (acc, now))
+    else:
+        for (uid,) in c.execute("SELECT id FROM users WHERE hashrate > 0 OR ref_hashrate > 0").fetchall():
+            settle(c, uid, now)
+    c.execute("INSERT INTO settings(k,v) VALUES('accrual_mode', ?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (mode,))
+    c.commit()
+    log.info("accrual mode switched: %s -> %s", prev, mode)
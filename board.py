@@ -0,0 +1,91 @@
+import sqlite3
+
+import accrual
+
+# счётчики ведут триггеры, поэтому их обновляет любой путь записи (ensure_user, вывод, одобрение, отклонение)
+SCHEMA = """
+CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance);
+CREATE INDEX IF NOT EXISTS idx_users_hashrate ON users(hashrate);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_status_id ON withdrawals(status, id);
+CREATE TABLE IF NOT EXISTS counters(
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO counters(name, value) VALUES('users', (SELECT COUNT(*) FROM users));
+INSERT OR IGNORE INTO counters(name, value) VALUES('withdrawals_pending', (SELECT COUNT(*) FROM withdrawals WHERE status='pending'));
+CREATE TRIGGER IF NOT EXISTS cnt_users_ins AFTER INSERT ON users
+BEGIN UPDATE counters SET value = value + 1 WHERE name='users'; END;
+CREATE TRIGGER IF NOT EXISTS cnt_users_del AFTER DELETE ON users
+BEGIN UPDATE counters SET value = value - 1 WHERE name='users'; END;
+CREATE TRIGGER IF NOT EXISTS cnt_wd_ins AFTER INSERT ON withdrawals WHEN NEW.status = 'pending'
+BEGIN UPDATE counters SET value = value + 1 WHERE name='withdrawals_pending'; END;
+CREATE TRIGGER IF NOT EXISTS cnt_wd_del AFTER DELETE ON withdrawals WHEN OLD.status = 'pending'
+BEGIN UPDATE counters SET value = value - 1 WHERE name='withdrawals_pending'; END;
+CREATE TRIGGER IF NOT EXISTS cnt_wd_upd AFTER UPDATE OF status ON withdrawals WHEN (OLD.status = 'pending') <> (NEW.status = 'pending')
+BEGIN UPDATE counters SET value = value + (CASE WHEN NEW.status = 'pending' THEN 1 ELSE -1 END) WHERE name='withdrawals_pending'; END;
+"""
+
+# в lazy-режиме живой баланс зависит от времени и не индексируется: берём кандидатов по индексам
+# (крупные балансы, крупный хешрейт и крупный хешрейт вместе с реферальным) и переранжируем их по живому значению
+LAZY_CANDIDATES = 200
+# курсор «с начала» для списков от новых к старым
+NEWEST = 2 ** 63 - 1
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    c.commit()
+
+
+def counter(c: sqlite3.Connection, name: str) -> int:
+    row = c.execute("SELECT value FROM counters WHERE name=?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def top_balances(c: sqlite3.Connection, limit: int, lazy: bool) -> list[tuple[str, float]]:
+    if not lazy:
+        # обратный обход idx_users_balance: O(K)
+        return c.execute("SELECT username, balance FROM users ORDER BY balance DESC LIMIT ?", (limit,)).fetchall()
+    acc = accrual.acc_index()
+    n = max(limit, LAZY_CANDIDATES)
+    rows = c.execute(
+        "SELECT id, username, balance, hashrate, ref_hashrate, acc_mark FROM users WHERE id IN ("
+        " SELECT id FROM (SELECT id FROM users ORDER BY balance DESC LIMIT ?)"
+        " UNION SELECT id FROM (SELECT id FROM users ORDER BY hashrate DESC LIMIT ?)"
+        " UNION SELECT id FROM (SELECT id FROM users ORDER BY hashrate + ref_hashrate DESC LIMIT ?))", (n, n, n)).fetchall()
+    live = []
+    for _, uname, bal, hr, ref_hr, mark in rows:
+        own, ref = accrual.lazy_pending(hr, ref_hr, mark, acc)
+        live.append((uname, bal + own + ref))
+    live.sort(key=lambda r: r[1], reverse=True)
+    return live[:limit]
+
+
+# --- Keyset pagination ---
+def _page(c: sqlite3.Connection, sql: str, args: tuple, cursor: int, forward: bool, limit: int, desc: bool):
+    # sql — "SELECT ... FROM t WHERE <условие>", ключ — колонка id. Страница «вперёд» идёт после cursor
+    # (последний показанный id) в порядке показа, «назад» — перед cursor (первый показанный id).
+    # Возвращает (rows, has_prev, has_next); стоимость O(limit) при любой глубине листания.
+    asc = forward != desc
+    rows = c.execute(f"{sql} AND id {'>' if asc else '<'} ? ORDER BY id {'ASC' if asc else 'DESC'} LIMIT ?",
+                     (*args, cursor, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if forward:
+        initial = cursor == (NEWEST if desc else 0)
+        return rows, not initial, more
+    rows.reverse()
+    return rows, more, True
+
+
+def users_page(c: sqlite3.Connection, cursor: int = 0, forward: bool = True, limit: int = 20):
+    return _page(c, "SELECT id, username, balance, hashrate FROM users WHERE 1", (), cursor, forward, limit, desc=False)
+
+
+def pending_withdrawals_page(c: sqlite3.Connection, cursor: int = 0, forward: bool = True, limit: int = 10):
+    return _page(c, "SELECT id, user_id, amount, address, created_at FROM withdrawals WHERE status='pending'", (),
+                 cursor, forward, limit, desc=False)
+
+
+def accruals_page(c: sqlite3.Connection, cursor: int = NEWEST, forward: bool = True, limit: int = 20):
+    return _page(c, "SELECT id, user_id, amount, created_at FROM accruals WHERE 1", (), cursor, forward, limit, desc=True)
@@ -1,12 +1,10 @@
-
+import asyncio
 import logging
+import math
 import os
-import sqlite3
+import signal
 import time
-from contextlib import closing
 
-import re
-import requests
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 )
@@ -14,103 +12,71 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 )
 
+import accrual
+import addresses
+import board
+import broadcast
+import concurrency
+import cryptopay
+import ingest
+import ledger
+import metrics
+import payouts
+import persistence
+import referrals
+import storage
+
 # --- ENV ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN")  # from @CryptoBot
-CRYPTO_CREATE_URL = "https://pay.crypt.bot/api/createInvoice"
+CRYPTO_API_BASE = os.getenv("CRYPTO_API_BASE", cryptopay.API_BASE)  # можно направить на локальный стенд
+# webhook mode: Telegram updates and CryptoBot invoice_paid callbacks on one HTTP server
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL, e.g. https://cloud-mining-bot.onrender.com
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (ingest.default_webhook_secret(BOT_TOKEN) if BOT_TOKEN else "")
+PORT = int(os.getenv("PORT", "8080"))
+# /metrics (Prometheus): в webhook-режиме с METRICS_TOKEN — на том же сервере, иначе на METRICS_PORT, если задан;
+# без токена METRICS_PORT слушает только 127.0.0.1
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # ?token=... или Authorization: Bearer ...
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")  # куда /compact и ежедневная свёртка выгружают старые строки accruals
+PAYOUT_DIR = os.getenv("PAYOUT_DIR", "payouts")  # файлы пакетных выплат
 
 # Admins by username (without @)
 ADMIN_USERNAMES = {"mkru27"}  # <-- admin
 
 # Mining economy
 DEFAULT_RATE_USDT_PER_GH_PER_DAY = 0.01   # доход в USDT на каждый GH/s в день
+# batch — суточное начисление по всей таблице, lazy — доход считается при чтении с точностью до секунды
+ACCRUAL_MODE = os.getenv("ACCRUAL_MODE", "batch")
+LAZY_ACCRUAL = ACCRUAL_MODE == "lazy"
+# рефералка: проценты от дохода потомка по уровням, через запятую (1-й уровень — прямой реферер)
+REF_LEVELS = [float(p) / 100 for p in os.getenv("REF_LEVELS_PCT", "1").split(",")]
+# пакеты хешрейта: цена в USDT и сколько GH/s даёт
+PACKAGES = {
+    "10gh": {"amount": 1, "hashrate": 10, "description": "Покупка 10 GH/s"},
+}
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("miningbot")
 
 # --- DB ---
 DB_PATH = "db.sqlite"
-con = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = con.cursor()
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users(
-    id INTEGER PRIMARY KEY,
-    username TEXT,
-    balance REAL DEFAULT 0,
-    hashrate REAL DEFAULT 0,
-    ref_id INTEGER,
-    is_admin INTEGER DEFAULT 0,
-    wallet TEXT
-)""")
-cur.execute("""
-CREATE TABLE IF NOT EXISTS accruals(
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    amount REAL,
-    created_at INTEGER
-)""")
-cur.execute("""
-CREATE TABLE IF NOT EXISTS settings(
-    k TEXT PRIMARY KEY,
-    v TEXT
-)""")
-cur.execute("""
-CREATE TABLE IF NOT EXISTS withdrawals(
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    amount REAL,
-    address TEXT,
-    status TEXT DEFAULT 'pending',
-    created_at INTEGER
-)""")
-# init default rate if not exists
-cur.execute("INSERT OR IGNORE INTO settings(k,v) VALUES('rate_usdt_per_gh_per_day', ?)", (str(DEFAULT_RATE_USDT_PER_GH_PER_DAY),))
-con.commit()
-
-def db_get_rate() -> float:
-    with closing(sqlite3.connect(DB_PATH)) as c:
-        k = c.cursor()
-        k.execute("SELECT v FROM settings WHERE k='rate_usdt_per_gh_per_day'")
-        row = k.fetchone()
-        return float(row[0]) if row else DEFAULT_RATE_USDT_PER_GH_PER_DAY
-
-def db_set_rate(val: float):
-    with closing(sqlite3.connect(DB_PATH)) as c:
-        k = c.cursor()
-        k.execute("INSERT INTO settings(k,v) VALUES('rate_usdt_per_gh_per_day', ?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (str(val),))
-        c.commit()
-
-def ensure_user(user_id: int, username: str | None, ref_id: int | None = None):
-    cur.execute("SELECT id FROM users WHERE id=?", (user_id,))
-    if not cur.fetchone():
-        is_admin = 1 if (username or "").lower() in ADMIN_USERNAMES else 0
-        cur.execute("INSERT INTO users(id, username, ref_id, is_admin) VALUES(?,?,?,?)", (user_id, username or "", ref_id, is_admin))
-        con.commit()
-    else:
-        cur.execute("UPDATE users SET username=? WHERE id=?", (username or "", user_id))
-        con.commit()
-
-def get_user(user_id: int):
-    cur.execute("SELECT id, username, balance, hashrate, ref_id, is_admin, wallet FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        return None
-    return {"id": row[0], "username": row[1], "balance": row[2], "hashrate": row[3], "ref_id": row[4], "is_admin": row[5], "wallet": row[6]}
-
-# --- Address validation (basic regex for common chains) ---
-def detect_chain(addr: str) -> str | None:
-    a = addr.strip()
-    if re.fullmatch(r"0x[a-fA-F0-9]{40}", a):
-        return "EVM (ETH/BSC/Polygon/Arbitrum/etc.)"
-    if re.fullmatch(r"T[1-9A-HJ-NP-Za-km-z]{33}", a):
-        return "TRON (TRC20)"
-    if re.fullmatch(r"[13][a-km-zA-HJ-NP-Z1-9]{25,34}", a) or a.startswith("bc1"):
-        return "Bitcoin"
-    if re.fullmatch(r"[1-9A-HJ-NP-Za-km-z]{32,44}", a) and not a.startswith("T"):
-        return "Solana"
-    if re.fullmatch(r"[EU][A-Z0-9_-]{46}", a):
-        return "TON (base64)"
-    return None
+db = storage.Storage(DB_PATH, ADMIN_USERNAMES, LAZY_ACCRUAL)
+
+def init_db():
+    def init_settings(c):
+        # init default rate if not exists
+        c.execute("INSERT OR IGNORE INTO settings(k,v) VALUES(?, ?)", (storage.RATE_KEY, str(DEFAULT_RATE_USDT_PER_GH_PER_DAY)))
+    def init_lazy(c):
+        row = c.execute("SELECT v FROM settings WHERE k=?", (storage.RATE_KEY,)).fetchone()
+        accrual.init_lazy_schema(c, float(row[0]))
+        referrals.init_schema(c)
+        referrals.set_levels(c, REF_LEVELS)
+        accrual.switch_mode(c, ACCRUAL_MODE)
+    db.start(init_settings, accrual.init_schema, board.init_schema, ledger.init_schema, payouts.init_schema, cryptopay.init_schema, ingest.init_schema, broadcast.init_schema, persistence.init_schema, init_lazy)
+
+async def db_get_rate() -> float:
+    return await db.get_rate(DEFAULT_RATE_USDT_PER_GH_PER_DAY)
 
 # --- UI ---
 def main_menu_kb():
@@ -125,6 +91,41 @@ def main_menu_kb():
         InlineKeyboardButton("💸 Вывод", callback_data="withdraw")
     ]])
 
+# --- Text input routing ---
+# ожидаемый ввод — одно состояние в user_data["await"]; каждое состояние обслуживает ровно один обработчик.
+# Текст без ожидаемого ввода отбрасывается без обращения к БД
+TEXT_INPUTS: dict[str, tuple] = {}  # state -> (handler, admin_only)
+# флаги до введения состояний (могли сохраниться в user_state)
+LEGACY_AWAIT_FLAGS = {"await_wallet": "wallet", "await_withdraw": "withdraw", "await_rate": "rate", "await_give": "give"}
+
+def text_input(state: str, admin: bool = False):
+    def register(fn):
+        TEXT_INPUTS[state] = (metrics.instrument(fn), admin)
+        return fn
+    return register
+
+def expect_input(context: ContextTypes.DEFAULT_TYPE, state: str | None):
+    if state:
+        context.user_data["await"] = state
+    else:
+        context.user_data.pop("await", None)
+
+async def route_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ud = context.user_data
+    state = ud.get("await")
+    if state is None and ud:
+        for flag, legacy_state in LEGACY_AWAIT_FLAGS.items():
+            if ud.pop(flag, False):
+                state = ud["await"] = legacy_state
+    route = TEXT_INPUTS.get(state)
+    if route is None:
+        return
+    fn, admin = route
+    if admin and not await is_admin(update.effective_user.username):
+        expect_input(context, None)
+        return
+    await fn(update, context, (update.message.text or "").strip())
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     ref_id = None
@@ -132,7 +133,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ref_id = int(context.args[0])
         if ref_id == u.id:
             ref_id = None
-    ensure_user(u.id, u.username, ref_id)
+    await db.ensure_user(u.id, u.username, ref_id)
     await update.message.reply_text(
         "👋 Добро пожаловать в облачный майнинг!\nВыбирай действие ниже.",
         reply_markup=main_menu_kb()
@@ -142,140 +143,308 @@ async def cb_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     uid = q.from_user.id
-    user = get_user(uid)
+    user = await db.get_user(uid)
     if q.data == "balance":
         await q.edit_message_text(
             f"💰 Баланс: {user['balance']:.2f} USDT\n⚡ Хешрейт: {user['hashrate']:.2f} GH/s\n💼 Кошелёк: {user['wallet'] or 'не привязан'}",
             reply_markup=main_menu_kb())
     elif q.data == "buy_hashrate":
-        headers = {"Crypto-Pay-API-Token": CRYPTOBOT_TOKEN}
-        payload = {
-            "asset": "USDT",
-            "amount": 1,
-            "description": "Покупка 10 GH/s",
-            "payload": str(uid)
-        }
+        pkg = PACKAGES["10gh"]
         try:
-            r = requests.post(CRYPTO_CREATE_URL, headers=headers, json=payload, timeout=15)
-            j = r.json()
-            if j.get("ok") and j["result"].get("pay_url"):
-                pay_url = j["result"]["pay_url"]
-                invoice_id = j["result"]["invoice_id"]
-                context.user_data["last_invoice_id"] = invoice_id
-                await q.edit_message_text(
-                    f"🧾 Счёт создан.\nОплати по ссылке: {pay_url}\n\n"
-                    f"После оплаты пока используйте команду:\n/confirm {invoice_id}",
-                    reply_markup=main_menu_kb()
-                )
-            else:
-                await q.edit_message_text("❌ Не удалось создать счёт. Попробуй позже.", reply_markup=main_menu_kb())
-        except Exception as e:
-            await q.edit_message_text(f"Ошибка соединения с CryptoBot: {e}", reply_markup=main_menu_kb())
+            inv = await crypto.get_or_create_invoice(uid, "10gh", pkg["amount"], pkg["description"])
+        except cryptopay.CryptoPayError as e:
+            log.warning("createInvoice failed for %s: %s", uid, e)
+            await q.edit_message_text("❌ Не удалось создать счёт. Попробуй позже.", reply_markup=main_menu_kb())
+            return
+        context.user_data["last_invoice_id"] = inv["invoice_id"]
+        if WEBHOOK_URL:
+            after = "Хешрейт начислится автоматически после оплаты."
+        else:
+            after = f"После оплаты используй команду:\n/confirm {inv['invoice_id']}"
+        await q.edit_message_text(
+            f"🧾 {'Счёт уже создан' if inv['reused'] else 'Счёт создан'}.\nОплати по ссылке: {inv['pay_url']}\n\n{after}",
+            reply_markup=main_menu_kb()
+        )
     elif q.data == "invite":
         bot_name = (await context.bot.get_me()).username
-        await q.edit_message_text(f"🔗 Твоя реферальная ссылка:\nhttps://t.me/{bot_name}?start={uid}", reply_markup=main_menu_kb())
+        st = await db.read(referrals.stats, uid)
+        levels = " / ".join(f"{p * 100:g}%" for p in REF_LEVELS)
+        await q.edit_message_text(
+            f"🔗 Твоя реферальная ссылка:\nhttps://t.me/{bot_name}?start={uid}\n\n"
+            f"Бонус с дохода рефералов по уровням: {levels}\n"
+            f"👥 Прямых рефералов: {st['direct']}, в глубину: {st['indirect']}\n"
+            f"⚡ Хешрейт команды: {st['downstream_hashrate']:.2f} GH/s\n"
+            f"💰 Заработано на рефералах: {st['bonus']:.4f} USDT",
+            reply_markup=main_menu_kb())
     elif q.data == "income_info":
-        rate = db_get_rate()
-        await q.edit_message_text(f"📈 Текущая доходность: {rate:.6f} USDT на 1 GH/s в день.\n"
-                                  f"При твоём хешрейте {user['hashrate']:.2f} GH/s — это {(user['hashrate']*rate):.4f} USDT/день.",
-                                  reply_markup=main_menu_kb())
+        rate = await db_get_rate()
+        text = (f"📈 Текущая доходность: {rate:.6f} USDT на 1 GH/s в день.\n"
+                f"При твоём хешрейте {user['hashrate']:.2f} GH/s — это {(user['hashrate']*rate):.4f} USDT/день.")
+        if LAZY_ACCRUAL:
+            ref_daily = user["ref_hashrate"] * rate
+            text += f"\nРеферальный бонус: {ref_daily:.4f} USDT/день.\nДоход начисляется непрерывно, каждую секунду."
+        totals = await db.read(ledger.user_totals, uid)
+        history = await db.read(ledger.user_history, uid, 5)
+        text += f"\n\n💰 Всего начислено: {totals['total']:.4f} USDT"
+        if history:
+            text += "\nПоследние начисления:\n" + "\n".join(f"• {when}: +{amount:.4f}" for when, amount in history)
+        await q.edit_message_text(text, reply_markup=main_menu_kb())
     elif q.data == "wallet":
         await q.edit_message_text("Пришли адрес для вывода (поддерживаются ETH/BSC/Polygon: `0x...`, TRC20: `T...`, TON: `EQ...`, Solana: base58).",
                                   reply_markup=None, parse_mode="Markdown")
-        context.user_data["await_wallet"] = True
+        expect_input(context, "wallet")
     elif q.data == "withdraw":
         if not user["wallet"]:
             await q.edit_message_text("Сначала привяжи кошелёк: нажми «💼 Кошелёк».", reply_markup=main_menu_kb())
         else:
             await q.edit_message_text(f"Отправь сумму для вывода в USDT (числом). Кошелёк: `{user['wallet']}`", reply_markup=None, parse_mode="Markdown")
-            context.user_data["await_withdraw"] = True
+            expect_input(context, "withdraw")
 
-async def text_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@text_input("wallet")
+async def input_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, msg: str):
+    chain = addresses.detect_chain(msg)
+    if not chain:
+        await update.message.reply_text("❌ Адрес не похож на поддерживаемый. Пример: 0x.. (EVM), T.. (TRC20), EQ.. (TON), base58 (Solana). Пришли ещё раз.")
+        return
+    await db.set_wallet(update.effective_user.id, msg)
+    expect_input(context, None)
+    await update.message.reply_text(f"✅ Кошелёк сохранён ({chain}):\n{msg}", reply_markup=main_menu_kb())
+
+@text_input("withdraw")
+async def input_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE, msg: str):
+    try:
+        amount = float(msg.replace(",", "."))
+    except ValueError:
+        await update.message.reply_text("Сумма должна быть числом. Пришли ещё раз.")
+        return
     uid = update.effective_user.id
-    user = get_user(uid)
-    msg = (update.message.text or "").strip()
-    # wallet binding
-    if context.user_data.get("await_wallet"):
-        chain = detect_chain(msg)
-        if not chain:
-            await update.message.reply_text("❌ Адрес не похож на поддерживаемый. Пример: 0x.. (EVM), T.. (TRC20), EQ.. (TON), base58 (Solana). Пришли ещё раз.")
-            return
-        cur.execute("UPDATE users SET wallet=? WHERE id=?", (msg, uid))
-        con.commit()
-        context.user_data["await_wallet"] = False
-        await update.message.reply_text(f"✅ Кошелёк сохранён ({chain}):\n{msg}", reply_markup=main_menu_kb())
+    user = await db.get_user(uid)
+    if not user or not user["wallet"]:
+        expect_input(context, None)
+        await update.message.reply_text("Сначала привяжи кошелёк: нажми «💼 Кошелёк».", reply_markup=main_menu_kb())
         return
-    # withdraw request
-    if context.user_data.get("await_withdraw"):
-        try:
-            amount = float(msg.replace(",", "."))
-        except:
-            await update.message.reply_text("Сумма должна быть числом. Пришли ещё раз.")
-            return
-        if amount <= 0 or amount > user["balance"]:
-            await update.message.reply_text(f"Недостаточно средств или некорректная сумма. Баланс: {user['balance']:.2f} USDT")
-            return
-        now = int(time.time())
-        cur.execute("INSERT INTO withdrawals(user_id, amount, address, created_at) VALUES(?,?,?,?)", (uid, amount, user["wallet"], now))
-        con.commit()
-        context.user_data["await_withdraw"] = False
-        await update.message.reply_text("✅ Заявка на вывод создана. Админ обработает её вручную.", reply_markup=main_menu_kb())
+    ok, balance = await db.create_withdrawal(uid, amount, user["wallet"], addresses.detect_chain(user["wallet"]) or "")
+    if not ok:
+        await update.message.reply_text(f"Недостаточно средств или некорректная сумма. Баланс: {balance:.2f} USDT")
         return
+    expect_input(context, None)
+    await update.message.reply_text("✅ Заявка на вывод создана. Админ обработает её вручную.", reply_markup=main_menu_kb())
 
 # --- Manual confirm while no webhooks ---
 async def cmd_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.args:
+    if not context.args or not context.args[0].isdigit():
         await update.message.reply_text("Использование: /confirm <invoice_id>")
         return
     invoice_id = context.args[0]
-    uid = update.effective_user.id
-    # успешная покупка: +10 GH/s
-    cur.execute("UPDATE users SET hashrate = hashrate + 10 WHERE id=?", (uid,))
-    con.commit()
-    await update.message.reply_text(f"✅ Оплата {invoice_id} подтверждена. Хешрейт +10 GH/s.")
-
-# --- Daily accrual (1% ref on profit already) ---
-def do_daily_accrual():
-    rate = db_get_rate()
-    now = int(time.time())
-    with closing(sqlite3.connect(DB_PATH)) as c:
-        k = c.cursor()
-        k.execute("SELECT id, hashrate, ref_id FROM users")
-        rows = k.fetchall()
-        for uid, hr, ref_id in rows:
-            if hr <= 0: 
-                continue
-            accr = hr * rate
-            if accr <= 0:
-                continue
-            # начислим пользователю
-            k.execute("UPDATE users SET balance = balance + ? WHERE id=?", (accr, uid))
-            k.execute("INSERT INTO accruals(user_id, amount, created_at) VALUES(?,?,?)", (uid, accr, now))
-            # рефералка 1% от прибыли
-            if ref_id:
-                ref_bonus = accr * 0.01
-                k.execute("UPDATE users SET balance = balance + ? WHERE id=?", (ref_bonus, ref_id))
-                k.execute("INSERT INTO accruals(user_id, amount, created_at) VALUES(?,?,?)", (ref_id, ref_bonus, now))
-        c.commit()
+    # проверяем статус счёта в CryptoBot, начисление — тем же путём, что и у вебхука
+    try:
+        items = (await crypto.call("getInvoices", {"invoice_ids": invoice_id}))["items"]
+    except cryptopay.CryptoPayError as e:
+        log.warning("getInvoices %s failed: %s", invoice_id, e)
+        await update.message.reply_text("Не удалось проверить оплату. Попробуй позже.")
+        return
+    if not items or items[0].get("status") != "paid":
+        await update.message.reply_text(f"Счёт {invoice_id} ещё не оплачен.")
+        return
+    credited = await db.write(ingest.apply_payments, items, PACKAGES, LAZY_ACCRUAL)
+    if not credited:
+        await update.message.reply_text(f"Оплата {invoice_id} уже была учтена.")
+        return
+    _, _, hr = credited[0]
+    await update.message.reply_text(f"✅ Оплата {invoice_id} подтверждена. Хешрейт +{hr:g} GH/s.")
+
+async def notify_credited(credited: list[tuple[int, int, float]]):
+    # через outbox одной транзакцией: всплеск оплат не упирается в лимиты Telegram и переживает рестарт
+    def enqueue(c):
+        for uid, invoice_id, hr in credited:
+            broadcast.send_one(c, uid, f"✅ Оплата {invoice_id} получена. Хешрейт +{hr:g} GH/s.")
+    await db.write(enqueue)
+    if outbox:
+        outbox.wake()
+
+# --- Daily accrual (multi-level ref bonus included) ---
+def do_daily_accrual() -> dict:
+    # идемпотентно в пределах суток: повторный запуск только докатывает незавершённый прогон
+    # (блокирующая: чанки идут через поток-писатель, вызывать через asyncio.to_thread)
+    if LAZY_ACCRUAL:
+        return {"lazy": True}
+    stats = accrual.run_accrual(db.write_sync, db.get_rate_sync(DEFAULT_RATE_USDT_PER_GH_PER_DAY))
+    if not stats["already_done"]:
+        metrics.histogram("accrual_seconds").observe(stats["seconds"])
+        metrics.set_gauge("accrual_last_rows", stats["rows"])
+        metrics.set_gauge("accrual_last_rows_per_sec", stats["rows_per_sec"])
+    return stats
+
+async def accrue_and_notify() -> dict:
+    # после завершённого прогона — дайджест «начислено X» каждому, кто что-то получил (один раз за период)
+    stats = await asyncio.to_thread(do_daily_accrual)
+    if not stats.get("lazy"):
+        stats["digests"] = await asyncio.to_thread(broadcast.queue_digest, db, stats["period"])
+        if stats["digests"] and outbox:
+            outbox.wake()
+    return stats
+
+def accrual_report(stats: dict) -> str:
+    if stats.get("lazy"):
+        return "ℹ️ Включено непрерывное начисление: балансы обновляются автоматически."
+    if stats["already_done"]:
+        return f"ℹ️ Начисление за {stats['period']} уже выполнено."
+    text = (f"✅ Начисление за {stats['period']} выполнено: {stats['rows']} польз. "
+            f"за {stats['seconds']:.2f} с ({stats['rows_per_sec']:.0f} строк/с).")
+    if stats.get("digests"):
+        text += f"\n📣 Уведомлений в очереди: {stats['digests']}."
+    return text
+
+async def accrual_job(bot, chat_id: int):
+    stats = await accrue_and_notify()
+    await bot.send_message(chat_id, accrual_report(stats), reply_markup=admin_kb())
 
 async def cmd_run_accrual(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.username):
+    if not await is_admin(update.effective_user.username):
+        return
+    chat_id = update.effective_chat.id
+    await update.message.reply_text(run_job(chat_id, "accrual", accrual_job, context.bot, chat_id))
+
+# --- Ledger maintenance ---
+async def cmd_compact(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update.effective_user.username):
+        return
+    chat_id = update.effective_chat.id
+    await update.message.reply_text(run_job(chat_id, "compact", compact_job, context.bot, chat_id))
+
+async def compact_job(bot, chat_id: int):
+    st = await asyncio.to_thread(ledger.compact, db, archive_dir=ARCHIVE_DIR)
+    mb = 1024 * 1024
+    await bot.send_message(chat_id,
+        f"✅ Компакция: {st['raw_rows']} строк → дневные итоги, {st['daily_rows']} дневных → месячные.\n"
+        f"Архив: {st['archive'] or 'нет'}\n"
+        f"Размер БД: {st['bytes_before'] / mb:.1f} → {st['bytes_after'] / mb:.1f} МБ (свободно {st['free_bytes'] / mb:.1f} МБ), "
+        f"{st['seconds']:.1f} с.\n"
+        f"Сверка журнала: ✅ каждый чанк сведён до нано-USDT, всего {st['total_nanos'] / ledger.NANOS:.4f} USDT.")
+
+# --- Address re-validation ---
+async def cmd_addrcheck(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update.effective_user.username):
+        return
+    chat_id = update.effective_chat.id
+    await update.message.reply_text(run_job(chat_id, "addrcheck", addrcheck_job, context.bot, chat_id))
+
+async def addrcheck_job(bot, chat_id: int):
+    st = await asyncio.to_thread(addresses.revalidate, db)
+    text = (f"🔎 Кошельки: {st['bad_wallets']} невалидных из {st['wallets']}.\n"
+            f"Заявки: {st['bad_pending']} невалидных из {st['pending']}, сеть обновлена у {st['updated']}.\n"
+            f"{st['seconds']:.1f} с.")
+    if st["sample"]:
+        text += "\nПримеры user_id: " + ", ".join(map(str, st["sample"]))
+    await bot.send_message(chat_id, text)
+
+# --- Batch payouts ---
+PAYOUT_HELP = ("📦 Пакетная выплата: /payout [chain=tron|evm|ton|solana|bitcoin] [min=5] [max=100] "
+               "[older=24h] [limit=1000] [fmt=csv|jsonl]\n"
+               "Покажу сколько заявок попадает под фильтр, после подтверждения одобрю их одной транзакцией "
+               "и пришлю файл выплат.")
+
+async def cmd_payout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update.effective_user.username):
+        return
+    try:
+        f = payouts.parse_filter(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"Не понял параметр: {e}\n\n{PAYOUT_HELP}")
+        return
+    await asyncio.to_thread(payouts.backfill_all, db, addresses.detect_chain)
+    n, total = await db.read(payouts.preview, f, int(time.time()))
+    if not n:
+        await update.message.reply_text(f"Под фильтр ({payouts.describe_filter(f)}) не попало ни одной заявки.")
         return
-    do_daily_accrual()
-    await update.message.reply_text("✅ Начисление выполнено.")
+    context.user_data["payout_filter"] = f
+    await update.message.reply_text(
+        f"📦 Фильтр: {payouts.describe_filter(f)}\nЗаявок: {n}, сумма {total:.2f} USDT.\nОдобрить пачку?",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Одобрить", callback_data="adm_pb_go"),
+                                            InlineKeyboardButton("✖️ Отмена", callback_data="adm_back")]]))
+
+async def run_payout_batch(q, context: ContextTypes.DEFAULT_TYPE):
+    f = context.user_data.pop("payout_filter", None)
+    if not f:
+        await q.edit_message_text("Фильтр устарел, запусти /payout заново.", reply_markup=admin_kb())
+        return
+    await q.edit_message_text(run_job(q.message.chat_id, "payout", payout_job, q, f))
+
+async def payout_job(q, f: dict):
+    res = await asyncio.to_thread(payouts.run_batch, db, f, addresses.detect_chain, PAYOUT_DIR)
+    lines = [f"✅ Пачка #{res['batch_id']}: одобрено {res['approved']} из {res['selected']}, списано {res['total']:.2f} USDT "
+             f"за {res['seconds']:.1f} с."]
+    for reason, cnt in res["failures"].items():
+        lines.append(f"⚠️ {reason}: {cnt}")
+    if res["sample"]:
+        lines.append("Примеры: " + ", ".join(f"#{wid} ({reason})" for wid, reason in res["sample"]))
+    await q.edit_message_text("\n".join(lines), reply_markup=admin_kb())
+    if res["approved"]:
+        await db.write(broadcast.notify_batch, res["batch_id"])
+        if outbox:
+            outbox.wake()
+    if res["exported"]:
+        with open(res["path"], "rb") as fh:
+            await q.message.reply_document(fh, filename=os.path.basename(res["path"]))
+
+# --- Notifications ---
+BROADCAST_HELP = "📣 Рассылка всем пользователям: /broadcast текст сообщения"
+
+async def notify(uid: int, text: str):
+    # через outbox: отправит Broadcaster с учётом лимитов Telegram
+    await db.write(broadcast.send_one, uid, text)
+    if outbox:
+        outbox.wake()
+
+async def queue_broadcast(key: str, text: str) -> int:
+    _, n = await asyncio.to_thread(broadcast.broadcast_all, db, key, text)
+    if outbox:
+        outbox.wake()
+    return n
+
+async def broadcast_status() -> str:
+    lines = [BROADCAST_HELP, f"В очереди сообщений: {await db.read(broadcast.pending_count)}"]
+    for bid, key, status, total, sent, failed in await db.read(broadcast.recent, 5):
+        lines.append(f"#{bid} {key.split(':')[0]} [{status}]: {sent}/{total} отправлено, {failed} ошибок")
+    return "\n".join(lines)
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update.effective_user.username):
+        return
+    text = update.message.text.partition(" ")[2].strip()
+    if not text:
+        await update.message.reply_text(await broadcast_status())
+        return
+    n = await queue_broadcast(f"admin:{time.time_ns()}", text)
+    await update.message.reply_text(f"📣 Рассылка поставлена в очередь: {n} получателей.")
+
+# --- Background admin jobs ---
+JOB_STATES = {"queued": "🕒", "running": "⏳", "done": "✅", "failed": "❌", "cancelled": "✖️"}
+
+def run_job(chat_id: int, name: str, coro_fn, *args) -> str:
+    # долгие задачи не держат очередь апдейтов админа: запускаем в фоне, результат придёт отдельным сообщением
+    job, new = jobs.submit(name, chat_id, coro_fn, *args)
+    if not new:
+        return f"⏳ Задача #{job.id} ({name}) уже выполняется."
+    return f"⏳ Задача #{job.id} ({name}) запущена, пришлю результат."
+
+def jobs_status() -> str:
+    lines = ["🛠 Фоновые задачи:"]
+    now = time.time()
+    for job in jobs.recent():
+        took = ((job.finished_at or now) - job.started_at) if job.started_at else 0.0
+        line = f"{JOB_STATES[job.state]} #{job.id} {job.name} — {took:.1f} с"
+        lines.append(line + (f" ({job.error})" if job.error else ""))
+    if len(lines) == 1:
+        lines.append("пока не было")
+    st = processor.stats
+    lines.append(f"\nАпдейты: {st['processed']} обработано, {processor.current_concurrent_updates} сейчас, "
+                 f"{st['merged_taps']} повторных нажатий слито, {st['dropped_flood']} отброшено (флуд).")
+    return "\n".join(lines)
 
 # --- Admin ---
-def is_admin(username: str | None) -> bool:
-    return (username or "").lower() in ADMIN_USERNAMES or (get_user_by_username(username) or {}).get("is_admin") == 1
-
-def get_user_by_username(username: str | None):
-    if not username:
-        return None
-    cur.execute("SELECT id, username, balance, hashrate, ref_id, is_admin, wallet FROM users WHERE LOWER(username)=LOWER(?)", (username,))
-    row = cur.fetchone()
-    if not row:
-        return None
-    return {"id": row[0], "username": row[1], "balance": row[2], "hashrate": row[3], "ref_id": row[4], "is_admin": row[5], "wallet": row[6]}
+async def is_admin(username: str | None) -> bool:
+    return (username or "").lower() in ADMIN_USERNAMES or ((await db.get_user_by_username(username)) or {}).get("is_admin") == 1
 
 def admin_kb():
     return InlineKeyboardMarkup([
@@ -284,11 +453,36 @@ def admin_kb():
         [InlineKeyboardButton("⚙️ Ставка дохода", callback_data="adm_set_rate"),
          InlineKeyboardButton("➕ Выдать баланс", callback_data="adm_give")],
         [InlineKeyboardButton("💸 Выводы (pending)", callback_data="adm_withdrawals"),
-         InlineKeyboardButton("🚀 Начислить сейчас", callback_data="adm_accrual_now")]
+         InlineKeyboardButton("🚀 Начислить сейчас", callback_data="adm_accrual_now")],
+        [InlineKeyboardButton("📋 Список пользователей", callback_data="adm_ul_n_0"),
+         InlineKeyboardButton("🧾 Начисления", callback_data=f"adm_al_n_{board.NEWEST}")],
+        [InlineKeyboardButton("📦 Пакетная выплата", callback_data="adm_pb_help"),
+         InlineKeyboardButton("🤝 Рефералы", callback_data="adm_refs")],
+        [InlineKeyboardButton("📣 Рассылка", callback_data="adm_bc"),
+         InlineKeyboardButton("🛠 Задачи", callback_data="adm_jobs")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="adm_stats")]
     ])
 
+def pager_kb(prefix: str, rows, has_prev: bool, has_next: bool, extra=()):
+    # keyset-листание: в callback_data лежит id крайней показанной строки, а не номер страницы
+    kb = list(extra)
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}_p_{rows[0][0]}"))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}_n_{rows[-1][0]}"))
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton("⟵ Назад", callback_data="adm_back")])
+    return InlineKeyboardMarkup(kb)
+
+def parse_page(data: str) -> tuple[int, bool]:
+    # adm_xx_n_<id> / adm_xx_p_<id>
+    _, _, direction, cursor = data.split("_")
+    return int(cursor), direction == "n"
+
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.username):
+    if not await is_admin(update.effective_user.username):
         await update.message.reply_text("⛔ Недостаточно прав.")
         return
     await update.message.reply_text("Админ-панель:", reply_markup=admin_kb())
@@ -296,133 +490,276 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cb_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    if not is_admin(q.from_user.username):
+    if not await is_admin(q.from_user.username):
         await q.edit_message_text("⛔ Нет прав.")
         return
     data = q.data
     if data == "adm_users_count":
-        cur.execute("SELECT COUNT(*) FROM users")
-        n = cur.fetchone()[0]
-        await q.edit_message_text(f"👥 Пользователей: {n}", reply_markup=admin_kb())
+        n = await db.counter("users")
+        pending = await db.counter("withdrawals_pending")
+        cs = db.cache.stats()
+        await q.edit_message_text(f"👥 Пользователей: {n}\n💸 Ожидающих выводов: {pending}\n"
+                                  f"🗄 Кэш: {cs['size']} записей, попаданий {cs['hit_ratio']:.0%} "
+                                  f"({cs['hits']}/{cs['hits'] + cs['misses']}), вытеснено {cs['evictions']}",
+                                  reply_markup=admin_kb())
     elif data == "adm_top":
-        cur.execute("SELECT username, balance FROM users ORDER BY balance DESC LIMIT 10")
-        rows = cur.fetchall()
+        rows = await db.top_balances(10)
         lines = ["🏆 Топ по балансу:"]
         for i, (uname, bal) in enumerate(rows, start=1):
             shown = ("@" + uname) if uname else "(без ника)"
             lines.append(f"{i}. {shown} — {bal:.2f} USDT")
         await q.edit_message_text("\n".join(lines), reply_markup=admin_kb())
+    elif data == "adm_refs":
+        rows = await db.read(referrals.top_referrers, 10)
+        lines = ["🤝 Топ рефереров по бонусу:"]
+        for i, (ref_uid, uname, direct, indirect, bonus, team_hr) in enumerate(rows, start=1):
+            shown = ("@" + uname) if uname else str(ref_uid)
+            lines.append(f"{i}. {shown} — {direct} прямых, {indirect} в глубину, {team_hr:.0f} GH/s, {bonus:.2f} USDT")
+        await q.edit_message_text("\n".join(lines), reply_markup=admin_kb())
     elif data == "adm_set_rate":
-        await q.edit_message_text(f"Текущая ставка: {db_get_rate():.6f}\nПришли сообщением новую ставку (USDT за 1 GH/s/день).",
+        await q.edit_message_text(f"Текущая ставка: {await db_get_rate():.6f}\nПришли сообщением новую ставку (USDT за 1 GH/s/день).",
                                   reply_markup=None)
-        context.user_data["await_rate"] = True
+        expect_input(context, "rate")
     elif data == "adm_give":
         await q.edit_message_text("Пришли в формате: @username 10  (или user_id 10)",
                                   reply_markup=None)
-        context.user_data["await_give"] = True
+        expect_input(context, "give")
     elif data == "adm_accrual_now":
-        do_daily_accrual()
-        await q.edit_message_text("✅ Начисление выполнено.", reply_markup=admin_kb())
-    elif data == "adm_withdrawals":
-        cur.execute("SELECT id, user_id, amount, address, status FROM withdrawals WHERE status='pending' ORDER BY id ASC LIMIT 10")
-        rows = cur.fetchall()
+        await q.edit_message_text(run_job(q.message.chat_id, "accrual", accrual_job, context.bot, q.message.chat_id),
+                                  reply_markup=admin_kb())
+    elif data == "adm_withdrawals" or data.startswith("adm_wl_"):
+        cursor, forward = parse_page(data) if data.startswith("adm_wl_") else (0, True)
+        rows, has_prev, has_next = await db.pending_withdrawals_page(cursor, forward)
         if not rows:
             await q.edit_message_text("Нет ожидающих заявок.", reply_markup=admin_kb())
             return
-        lines = ["💸 Ожидающие выводы:"]
+        lines = [f"💸 Ожидающие выводы (всего {await db.counter('withdrawals_pending')}):"]
         kb = []
-        for wid, uid, amt, addr, st in rows:
+        for wid, uid, amt, addr, created in rows:
             lines.append(f"#{wid}: uid {uid}, {amt:.2f} USDT, {addr}")
             kb.append([InlineKeyboardButton(f"✅ #{wid}", callback_data=f"adm_w_ok_{wid}"),
                        InlineKeyboardButton(f"❌ #{wid}", callback_data=f"adm_w_rej_{wid}")])
-        kb.append([InlineKeyboardButton("⟵ Назад", callback_data="adm_back")])
-        await q.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb))
+        await q.edit_message_text("\n".join(lines), reply_markup=pager_kb("adm_wl", rows, has_prev, has_next, kb))
+
+    elif data.startswith("adm_ul_"):
+        rows, has_prev, has_next = await db.users_page(*parse_page(data))
+        lines = [f"📋 Пользователи (всего {await db.counter('users')}):"]
+        for uid, uname, bal, hr in rows:
+            shown = ("@" + uname) if uname else "(без ника)"
+            lines.append(f"{uid} {shown} — {bal:.2f} USDT, {hr:.2f} GH/s")
+        await q.edit_message_text("\n".join(lines), reply_markup=pager_kb("adm_ul", rows, has_prev, has_next))
+
+    elif data.startswith("adm_al_"):
+        rows, has_prev, has_next = await db.accruals_page(*parse_page(data))
+        lines = ["🧾 Начисления (новые сверху):"]
+        for aid, uid, amt, created in rows:
+            lines.append(f"#{aid} {time.strftime('%Y-%m-%d %H:%M', time.gmtime(created))} uid {uid}: +{amt:.4f} USDT")
+        if not rows:
+            lines.append("Пусто.")
+        await q.edit_message_text("\n".join(lines), reply_markup=pager_kb("adm_al", rows, has_prev, has_next))
+
+    elif data == "adm_pb_help":
+        await q.edit_message_text(PAYOUT_HELP, reply_markup=admin_kb())
+    elif data == "adm_jobs":
+        await q.edit_message_text(jobs_status(), reply_markup=admin_kb())
+    elif data == "adm_stats":
+        await q.edit_message_text(metrics.summary(), reply_markup=admin_kb())
+    elif data == "adm_bc":
+        await q.edit_message_text(await broadcast_status() + "\n\nПришли сообщением текст рассылки.",
+                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⟵ Назад", callback_data="adm_back")]]))
+        expect_input(context, "broadcast")
+    elif data == "adm_pb_go":
+        await run_payout_batch(q, context)
 
     elif data == "adm_back":
+        expect_input(context, None)
         await q.edit_message_text("Админ-панель:", reply_markup=admin_kb())
 
     elif data.startswith("adm_w_ok_"):
         wid = int(data.split("_")[-1])
-        # одобрение: списываем баланс и помечаем approved
-        cur.execute("SELECT user_id, amount FROM withdrawals WHERE id=? AND status='pending'", (wid,))
-        row = cur.fetchone()
+        row = await db.approve_withdrawal(wid)
         if not row:
             await q.edit_message_text("Заявка не найдена или уже обработана.", reply_markup=admin_kb()); return
-        uid, amt = row
-        cur.execute("UPDATE users SET balance = balance - ? WHERE id=? AND balance >= ?", (amt, uid, amt))
-        cur.execute("UPDATE withdrawals SET status='approved' WHERE id=?", (wid,))
-        con.commit()
+        uid, amt, ok = row
+        if not ok:
+            await q.edit_message_text(f"⚠️ Заявка #{wid}: у пользователя {uid} недостаточно средств для {amt:.2f} USDT. "
+                                      f"Заявка оставлена в ожидании.", reply_markup=admin_kb())
+            return
+        await notify(uid, f"✅ Вывод {amt:.2f} USDT одобрен и отправлен в выплату.")
         await q.edit_message_text(f"✅ Заявка #{wid} одобрена. Списано {amt:.2f} USDT.", reply_markup=admin_kb())
 
     elif data.startswith("adm_w_rej_"):
         wid = int(data.split("_")[-1])
-        cur.execute("UPDATE withdrawals SET status='rejected' WHERE id=?", (wid,))
-        con.commit()
+        if not await db.reject_withdrawal(wid):
+            await q.edit_message_text("Заявка не найдена или уже обработана.", reply_markup=admin_kb()); return
         await q.edit_message_text(f"❌ Заявка #{wid} отклонена.", reply_markup=admin_kb())
 
-async def admin_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.username):
+@text_input("rate", admin=True)
+async def input_rate(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    try:
+        val = float(text.replace(",", "."))
+    except ValueError:
+        await update.message.reply_text("Не удалось разобрать число. Пришли ещё раз.")
         return
-    text = (update.message.text or "").strip()
-    if context.user_data.get("await_rate"):
-        try:
-            val = float(text.replace(",", "."))
-            db_set_rate(val)
-            context.user_data["await_rate"] = False
-            await update.message.reply_text(f"✅ Ставка обновлена: {val:.6f}", reply_markup=admin_kb())
-        except:
-            await update.message.reply_text("Не удалось разобрать число. Пришли ещё раз.")
+    # nan/inf/отрицательная ставка испортили бы индекс дохода у всех пользователей
+    if not (math.isfinite(val) and val >= 0):
+        await update.message.reply_text("Ставка должна быть конечным числом ≥ 0. Пришли ещё раз.")
         return
-    if context.user_data.get("await_give"):
-        parts = text.split()
-        if len(parts) != 2:
-            await update.message.reply_text("Формат: @username 10  или  123456 10")
-            return
-        target, amount_s = parts
-        try:
-            amount = float(amount_s.replace(",", "."))
-        except:
-            await update.message.reply_text("Сумма должна быть числом."); return
-        uid = None
-        if target.startswith("@"):
-            u = get_user_by_username(target[1:])
-            uid = u["id"] if u else None
-        else:
-            if target.isdigit():
-                uid = int(target)
-        if not uid:
-            await update.message.reply_text("Пользователь не найден (должен написать боту хотя бы раз)."); return
-        cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (amount, uid))
-        con.commit()
-        context.user_data["await_give"] = False
-        await update.message.reply_text(f"✅ Выдал {amount} USDT пользователю {target}.", reply_markup=admin_kb())
+    await db.set_rate(val)
+    expect_input(context, None)
+    await queue_broadcast(f"rate:{time.time_ns()}", f"📈 Ставка дохода изменена: {val:.6f} USDT за 1 GH/s в день.")
+    await update.message.reply_text(f"✅ Ставка обновлена: {val:.6f}", reply_markup=admin_kb())
+
+@text_input("give", admin=True)
+async def input_give(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    parts = text.split()
+    if len(parts) != 2:
+        await update.message.reply_text("Формат: @username 10  или  123456 10")
+        return
+    target, amount_s = parts
+    try:
+        amount = float(amount_s.replace(",", "."))
+    except ValueError:
+        await update.message.reply_text("Сумма должна быть числом."); return
+    if not math.isfinite(amount):
+        await update.message.reply_text("Сумма должна быть конечным числом."); return
+    uid = None
+    if target.startswith("@"):
+        u = await db.get_user_by_username(target[1:])
+        uid = u["id"] if u else None
+    else:
+        if target.isdigit():
+            uid = int(target)
+    if not uid:
+        await update.message.reply_text("Пользователь не найден (должен написать боту хотя бы раз)."); return
+    await db.grant(uid, amount)
+    expect_input(context, None)
+    await update.message.reply_text(f"✅ Выдал {amount} USDT пользователю {target}.", reply_markup=admin_kb())
+
+@text_input("broadcast", admin=True)
+async def input_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    if not text:
+        await update.message.reply_text("Текст рассылки пуст. Пришли ещё раз.")
+        return
+    expect_input(context, None)
+    n = await queue_broadcast(f"admin:{time.time_ns()}", text)
+    await update.message.reply_text(f"📣 Рассылка поставлена в очередь: {n} получателей.", reply_markup=admin_kb())
 
 # --- App bootstrap ---
-def main():
-    if not BOT_TOKEN:
-        raise SystemExit("Set BOT_TOKEN env var")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    # commands
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("confirm", cmd_confirm))
-    app.add_handler(CommandHandler("admin", cmd_admin))
-    app.add_handler(CommandHandler("accrual", cmd_run_accrual))
+crypto: cryptopay.CryptoPayClient | None = None
+outbox: broadcast.Broadcaster | None = None
+outbox_task: asyncio.Task | None = None
+# апдейты разных юзеров — параллельно, одного юзера — последовательно
+processor = concurrency.UserSerialProcessor()
+jobs: concurrency.JobPool | None = None
+metrics_server = None
+for _k in processor.stats:
+    metrics.gauge_fn(f"updates_{_k}", lambda k=_k: processor.stats[k])
+
+async def on_startup(app):
+    global crypto, outbox, outbox_task, jobs, metrics_server
+    jobs = concurrency.JobPool(app.bot)
+    if METRICS_PORT and not (WEBHOOK_URL and METRICS_TOKEN):
+        metrics_server = metrics.make_app(METRICS_TOKEN).listen(METRICS_PORT, address="" if METRICS_TOKEN else "127.0.0.1")
+    crypto = cryptopay.CryptoPayClient(CRYPTOBOT_TOKEN, db, base_url=CRYPTO_API_BASE)
+    # рассылки, прерванные рестартом, докатываются из outbox
+    await asyncio.to_thread(broadcast.resume_enqueue, db)
+    outbox = broadcast.Broadcaster(app.bot, db)
+    outbox_task = asyncio.create_task(outbox.run())
+
+async def on_shutdown(app):
+    if metrics_server:
+        metrics_server.stop()
+    if jobs:
+        # до db.stop(): фоновые задачи в потоках дописывают свои чанки, пока писатель ещё работает
+        await jobs.shutdown()
+    if outbox_task:
+        outbox_task.cancel()
+    if crypto:
+        await crypto.aclose()
+    db.stop()
+
+def build_app(token: str, request=None):
+    # request — подмена HTTP-слоя Bot API (loadsim гоняет бота без Telegram)
+    # user_data (флаги ожидания ввода, фильтр выплаты) переживает рестарт: хранится в той же БД
+    builder = (ApplicationBuilder().token(token).concurrent_updates(processor)
+               .persistence(persistence.SQLitePersistence(db))
+               .post_init(on_startup).post_shutdown(on_shutdown))
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+
+    # commands (каждый хендлер обёрнут metrics.instrument: латентность видна в /metrics и «📊 Статистика»)
+    app.add_handler(CommandHandler("start", metrics.instrument(cmd_start)))
+    app.add_handler(CommandHandler("confirm", metrics.instrument(cmd_confirm)))
+    app.add_handler(CommandHandler("admin", metrics.instrument(cmd_admin)))
+    app.add_handler(CommandHandler("accrual", metrics.instrument(cmd_run_accrual)))
+    app.add_handler(CommandHandler("compact", metrics.instrument(cmd_compact)))
+    app.add_handler(CommandHandler("payout", metrics.instrument(cmd_payout)))
+    app.add_handler(CommandHandler("addrcheck", metrics.instrument(cmd_addrcheck)))
+    app.add_handler(CommandHandler("broadcast", metrics.instrument(cmd_broadcast)))
 
     # callbacks
-    app.add_handler(CallbackQueryHandler(cb_menu, pattern="^(balance|buy_hashrate|invite|income_info|wallet|withdraw)$"))
-    app.add_handler(CallbackQueryHandler(cb_admin, pattern="^adm_"))
+    app.add_handler(CallbackQueryHandler(metrics.instrument(cb_menu), pattern="^(balance|buy_hashrate|invite|income_info|wallet|withdraw)$"))
+    app.add_handler(CallbackQueryHandler(metrics.instrument(cb_admin), pattern="^adm_"))
 
-    # text flows (wallet / withdraw / admin inputs)
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), text_flow))
-    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), admin_text_input))
+    # text input: один обработчик, дальше — по состоянию ожидания ввода (TEXT_INPUTS)
+    app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), route_text))
+    return app
 
-    # schedule daily accrual every 24h
-    async def periodic_accrual(ctx: ContextTypes.DEFAULT_TYPE):
-        do_daily_accrual()
-    app.job_queue.run_repeating(periodic_accrual, interval=24*3600, first=30)
+def main():
+    if not BOT_TOKEN:
+        raise SystemExit("Set BOT_TOKEN env var")
+    init_db()
+    app = build_app(BOT_TOKEN)
 
-    app.run_polling(close_loop=False)
+    # daily accrual: one run per UTC day; checking hourly is safe because runs are idempotent per period
+    # (lazy mode has no sweep at all: balances are computed on read). Same job name as /accrual,
+    # so a scheduled run never overlaps a manual one
+    async def periodic_accrual(ctx: ContextTypes.DEFAULT_TYPE):
+        jobs.submit("accrual", None, accrue_and_notify)
+    if not LAZY_ACCRUAL:
+        app.job_queue.run_repeating(periodic_accrual, interval=3600, first=30)
+
+    # ledger retention: roll old raw accruals into daily/monthly summaries once a day
+    async def ledger_rollup(ctx: ContextTypes.DEFAULT_TYPE):
+        await asyncio.to_thread(ledger.compact, db, archive_dir=ARCHIVE_DIR)
+        before = int(time.time()) - broadcast.KEEP_DAYS * 86400
+        while await db.write(broadcast.purge, before) == broadcast.CHUNK_SIZE:
+            pass
+    app.job_queue.run_repeating(ledger_rollup, interval=24*3600, first=600)
+
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling(close_loop=False)
+
+async def run_webhook(app):
+    # no polling: Telegram and CryptoBot push to us; payments go through a batching worker
+    worker = ingest.PaymentWorker(db, PACKAGES, LAZY_ACCRUAL, on_credited=notify_credited)
+    server = ingest.make_server(app, WEBHOOK_SECRET, CRYPTOBOT_TOKEN, worker,
+                               metrics_token=METRICS_TOKEN).listen(PORT)
+    await app.initialize()
+    await on_startup(app)
+    await app.bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}/telegram", secret_token=WEBHOOK_SECRET,
+                              allowed_updates=Update.ALL_TYPES)
+    await app.start()
+    worker_task = asyncio.create_task(worker.run())
+    log.info("webhook server on :%d", PORT)
+    if not CRYPTOBOT_TOKEN:
+        log.warning("CRYPTOBOT_TOKEN not set: /cryptobot answers 403")
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        worker_task.cancel()
+        await app.stop()
+        # как в run_polling: post_shutdown последним, финальный сброс persistence ещё пишет в БД
+        await app.shutdown()
+        await on_shutdown(app)
 
 if __name__ == "__main__":
     main()
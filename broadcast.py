@@ -0,0 +1,345 @@
+"""Outbox-based mass messaging: persistent queue, token-bucket pacing, retry-after handling.
+
+    python broadcast.py --bench 5000 --rate 30
+
+pushes a broadcast through a stub Bot and prints the achieved throughput.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+log = logging.getLogger("miningbot.broadcast")
+
+# лимиты Telegram: ~30 сообщений/с на бота, ~1 сообщение/с в один чат
+GLOBAL_RATE = 25.0
+PER_CHAT_INTERVAL = 1.0
+CONCURRENCY = 16
+BATCH_SIZE = 200
+MAX_ATTEMPTS = 5
+POLL_INTERVAL = 5.0
+CHUNK_SIZE = 5000
+KEEP_DAYS = 7
+
+# broadcasts — рассылка целиком (cursor — последний id пользователя, поставленный в очередь, для возобновления),
+# outbox — по строке на сообщение; текст массовой рассылки хранится один раз в broadcasts
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE,
+    kind TEXT,
+    text TEXT,
+    since INTEGER,
+    until INTEGER,
+    cursor INTEGER DEFAULT 0,
+    status TEXT DEFAULT 'enqueuing',
+    total INTEGER DEFAULT 0,
+    sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    created_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS outbox(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    broadcast_id INTEGER,
+    chat_id INTEGER,
+    text TEXT,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    not_before INTEGER DEFAULT 0,
+    error TEXT,
+    created_at INTEGER,
+    sent_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(not_before, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_outbox_done ON outbox(created_at) WHERE status <> 'pending';
+"""
+
+DIGEST_TEXT = "💰 Начислено за %s: %.4f USDT"
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    c.commit()
+
+
+# --- Enqueue ---
+def _create(c: sqlite3.Connection, key: str, kind: str, text: str | None, since: int | None = None,
+            until: int | None = None) -> int | None:
+    # None — рассылка с таким ключом уже есть (повторный запуск начисления не дублирует дайджест)
+    cur = c.execute("INSERT OR IGNORE INTO broadcasts(key, kind, text, since, until, created_at) VALUES(?,?,?,?,?,?)",
+                    (key, kind, text, since, until, int(time.time())))
+    return cur.lastrowid if cur.rowcount else None
+
+
+def _enqueue_chunk(c: sqlite3.Connection, bid: int, chunk_size: int) -> bool:
+    # один чанк пользователей lo < id <= hi и курсор рассылки — в одной транзакции
+    kind, text, since, until, lo = c.execute("SELECT kind, text, since, until, cursor FROM broadcasts WHERE id=?",
+                                             (bid,)).fetchone()
+    hi = c.execute("SELECT MAX(id) FROM (SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?)",
+                   (lo, chunk_size)).fetchone()[0]
+    if hi is None:
+        c.execute("UPDATE broadcasts SET status=CASE WHEN sent+failed >= total THEN 'done' ELSE 'sending' END "
+                  "WHERE id=?", (bid,))
+        return False
+    now = int(time.time())
+    if kind == "digest":
+        # сумма начислений прогона по idx_accruals_user_created, текст — на каждого свой
+        n = c.execute("INSERT INTO outbox(broadcast_id, chat_id, text, created_at) "
+                      "SELECT ?, user_id, printf(?, ?, SUM(amount)), ? FROM accruals "
+                      "WHERE user_id > ? AND user_id <= ? AND created_at >= ? AND created_at <= ? "
+                      "GROUP BY user_id HAVING SUM(amount) > 0",
+                      (bid, DIGEST_TEXT, text, now, lo, hi, since, until)).rowcount
+    else:
+        n = c.execute("INSERT INTO outbox(broadcast_id, chat_id, created_at) SELECT ?, id, ? FROM users "
+                      "WHERE id > ? AND id <= ?", (bid, now, lo, hi)).rowcount
+    c.execute("UPDATE broadcasts SET cursor=?, total=total+? WHERE id=?", (hi, n, bid))
+    return True
+
+
+def enqueue(db, bid: int, chunk_size: int = CHUNK_SIZE) -> int:
+    # блокирующая: чанки через поток-писатель, вызывать через asyncio.to_thread
+    while db.write_sync(_enqueue_chunk, bid, chunk_size):
+        pass
+    return db.read_sync(lambda c: c.execute("SELECT total FROM broadcasts WHERE id=?", (bid,)).fetchone()[0])
+
+
+def resume_enqueue(db):
+    # рассылки, прерванные рестартом посреди постановки в очередь
+    for (bid,) in db.read_sync(lambda c: c.execute("SELECT id FROM broadcasts WHERE status='enqueuing'").fetchall()):
+        enqueue(db, bid)
+
+
+def broadcast_all(db, key: str, text: str) -> tuple[int | None, int]:
+    bid = db.write_sync(_create, key, "all", text)
+    return bid, enqueue(db, bid) if bid else 0
+
+
+def queue_digest(db, period: str) -> int:
+    # «ты заработал X» по завершённому прогону начисления: окно — время прогона из accrual_runs
+    run = db.read_sync(lambda c: c.execute("SELECT started_at, finished_at FROM accrual_runs "
+                                           "WHERE period=? AND status='done'", (period,)).fetchone())
+    if not run:
+        return 0
+    bid = db.write_sync(_create, f"digest:{period}", "digest", period, run[0], run[1])
+    return enqueue(db, bid) if bid else 0
+
+
+def send_one(c: sqlite3.Connection, chat_id: int, text: str):
+    c.execute("INSERT INTO outbox(chat_id, text, created_at) VALUES(?,?,?)", (chat_id, text, int(time.time())))
+
+
+def notify_batch(c: sqlite3.Connection, batch_id: int):
+    c.execute("INSERT INTO outbox(chat_id, text, created_at) "
+              "SELECT user_id, printf('✅ Вывод %.2f USDT одобрен и отправлен в выплату.', amount), ? "
+              "FROM withdrawals WHERE batch_id=?", (int(time.time()), batch_id))
+
+
+def purge(c: sqlite3.Connection, before: int, limit: int = CHUNK_SIZE) -> int:
+    return c.execute("DELETE FROM outbox WHERE rowid IN (SELECT rowid FROM outbox WHERE status <> 'pending' "
+                     "AND created_at < ? LIMIT ?)", (before, limit)).rowcount
+
+
+# --- Reads ---
+def _due(c: sqlite3.Connection, now: int, limit: int):
+    return c.execute("SELECT o.id, o.broadcast_id, o.chat_id, COALESCE(o.text, b.text), o.attempts FROM outbox o "
+                     "LEFT JOIN broadcasts b ON b.id = o.broadcast_id "
+                     "WHERE o.status='pending' AND o.not_before <= ? ORDER BY o.not_before, o.id LIMIT ?",
+                     (now, limit)).fetchall()
+
+
+def recent(c: sqlite3.Connection, limit: int = 5):
+    return c.execute("SELECT id, key, status, total, sent, failed FROM broadcasts ORDER BY id DESC LIMIT ?",
+                     (limit,)).fetchall()
+
+
+def pending_count(c: sqlite3.Connection) -> int:
+    return c.execute("SELECT COUNT(*) FROM outbox WHERE status='pending'").fetchone()[0]
+
+
+def _record(c: sqlite3.Connection, results: list[tuple]):
+    # итоги пачки одной транзакцией: статусы строк и счётчики рассылок
+    now = int(time.time())
+    c.executemany("UPDATE outbox SET status=?, attempts=attempts+?, not_before=?, error=?, sent_at=? WHERE id=?",
+                  [(status, tried, not_before, err, now if status == "sent" else None, oid)
+                   for oid, _, status, tried, not_before, err in results])
+    per: dict[int, list[int]] = {}
+    for _, bid, status, *_ in results:
+        if bid is not None and status != "pending":
+            per.setdefault(bid, [0, 0])[status != "sent"] += 1
+    c.executemany("UPDATE broadcasts SET sent=sent+?, failed=failed+?, "
+                  "status=CASE WHEN status='sending' AND sent+?+failed+? >= total THEN 'done' ELSE status END WHERE id=?",
+                  [(s, f, s, f, bid) for bid, (s, f) in per.items()])
+
+
+# --- Sender ---
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or 1.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _seconds(v) -> float:
+    return v.total_seconds() if hasattr(v, "total_seconds") else float(v)
+
+
+class Broadcaster:
+    # пачка due-строк из outbox → параллельная отправка под общим и почат-лимитом → итоги пачки одной записью.
+    # Доставка at-least-once: после падения посреди пачки её строки уйдут повторно
+    def __init__(self, bot, db, rate: float = GLOBAL_RATE, per_chat: float = PER_CHAT_INTERVAL,
+                 concurrency: int = CONCURRENCY, batch_size: int = BATCH_SIZE, poll: float = POLL_INTERVAL):
+        self.bot = bot
+        self.db = db
+        self.bucket = TokenBucket(rate)
+        self.per_chat = per_chat
+        self.sem = asyncio.Semaphore(concurrency)
+        self.batch_size = batch_size
+        self.poll = poll
+        self._chat_next: dict[int, float] = {}
+        self._wake = asyncio.Event()
+        self.stats = {"sent": 0, "failed": 0, "retried": 0, "flood_waits": 0}
+
+    def wake(self):
+        self._wake.set()
+
+    async def _chat_slot(self, chat_id: int):
+        now = time.monotonic()
+        at = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = at + self.per_chat
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _send(self, row) -> tuple:
+        oid, bid, chat_id, text, attempts = row
+        async with self.sem:
+            await self._chat_slot(chat_id)
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                self.stats["sent"] += 1
+                return oid, bid, "sent", 1, 0, None
+            except RetryAfter as e:
+                # флуд-контроль касается всего бота: ставим на паузу общий bucket, попытку не засчитываем
+                wait = _seconds(e.retry_after)
+                self.bucket.pause(wait)
+                self.stats["flood_waits"] += 1
+                return oid, bid, "pending", 0, int(time.time() + wait) + 1, "retry_after"
+            except (Forbidden, BadRequest) as e:
+                # заблокировал бота / чата нет: повтор не поможет
+                self.stats["failed"] += 1
+                return oid, bid, "failed", 1, 0, str(e)[:200]
+            except Exception as e:
+                # сеть, прочие ошибки Telegram и всё неожиданное: строка уходит в повтор, а не роняет gather
+                # вместе с уже отправленными строками пачки (их итоги иначе не запишутся и уйдут второй раз)
+                if not isinstance(e, TelegramError):
+                    log.warning("send to %s failed: %r", chat_id, e)
+                if attempts + 1 >= MAX_ATTEMPTS:
+                    self.stats["failed"] += 1
+                    return oid, bid, "failed", 1, 0, str(e)[:200]
+                self.stats["retried"] += 1
+                return oid, bid, "pending", 1, int(time.time()) + 5 * 2 ** attempts, str(e)[:200]
+
+    async def run_once(self) -> int:
+        rows = await self.db.read(_due, int(time.time()), self.batch_size)
+        if rows:
+            results = await asyncio.gather(*(self._send(r) for r in rows))
+            await self.db.write(_record, results)
+            now = time.monotonic()
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        return len(rows)
+
+    async def run(self):
+        while True:
+            try:
+                n = await self.run_once()
+            except Exception:
+                log.exception("broadcast batch failed")
+                n = 0
+            if not n:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll)
+                except asyncio.TimeoutError:
+                    pass
+
+
+# --- Offline ---
+class StubBot:
+    # заглушка Bot.send_message: задержка сети и флуд-контроль как у Telegram (RetryAfter при превышении лимита)
+    def __init__(self, latency: float = 0.03, limit: int = 30, fail_every: int = 0):
+        self.latency = latency
+        self.limit = limit
+        self.fail_every = fail_every
+        self.calls = 0
+        self.delivered = 0
+        self._window: list[float] = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        self._window = [t for t in self._window if t > now - 1]
+        if len(self._window) >= self.limit:
+            raise RetryAfter(1)
+        self._window.append(now)
+        if self.fail_every and self.calls % self.fail_every == 0:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.delivered += 1
+
+
+async def _bench(args):
+    import storage
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    db = storage.Storage(path, set(), False)
+    db.start(init_schema)
+    db.write_sync(lambda c: c.executemany("INSERT INTO users(id, username) VALUES(?,?)",
+                                          [(i, f"u{i}") for i in range(1, args.bench + 1)]))
+    started = time.perf_counter()
+    bid, n = await asyncio.to_thread(broadcast_all, db, "bench", "Тестовая рассылка")
+    enqueued = time.perf_counter() - started
+    bot = StubBot(latency=args.latency, limit=args.limit, fail_every=args.fail_every)
+    sender = Broadcaster(bot, db, rate=args.rate)
+    started = time.perf_counter()
+    while await db.read(pending_count):
+        if not await sender.run_once():
+            await asyncio.sleep(0.2)
+    elapsed = time.perf_counter() - started
+    print(f"enqueued {n} in {enqueued:.2f}s; delivered {bot.delivered} in {elapsed:.1f}s "
+          f"({bot.delivered / elapsed:.1f} msg/s), {sender.stats}")
+    print(db.read_sync(recent, 1))
+    db.stop()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--bench", type=int, default=2000, metavar="USERS")
+    p.add_argument("--rate", type=float, default=GLOBAL_RATE)
+    p.add_argument("--limit", type=int, default=30, help="stub flood limit, msg/s")
+    p.add_argument("--latency", type=float, default=0.03)
+    p.add_argument("--fail-every", type=int, default=0)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_bench(p.parse_args()))
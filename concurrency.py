@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+log = logging.getLogger("miningbot.concurrency")
+
+MAX_CONCURRENT_UPDATES = 256
+# сколько апдейтов одного юзера может ждать своей очереди; остальные отбрасываются
+MAX_PENDING_PER_USER = 5
+JOB_WORKERS = 2
+JOB_HISTORY = 20
+# сколько ждать работающие задачи при остановке: отмена не прерывает их потоки (asyncio.to_thread)
+JOB_SHUTDOWN_GRACE = 30.0
+
+
+class _UserSlot:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class UserSerialProcessor(BaseUpdateProcessor):
+    # апдейты разных юзеров идут параллельно, одного юзера — строго по очереди (user_data-флаги ожидания ввода
+    # и проверки баланса не гоняются между собой). Повторный тап той же кнопки, пока первый ещё в очереди или
+    # выполняется, сливается с ним; сверх MAX_PENDING_PER_USER апдейты юзера отбрасываются
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES, max_pending: int = MAX_PENDING_PER_USER):
+        super().__init__(max_concurrent_updates)
+        self.max_pending = max_pending
+        self._slots: dict[int, _UserSlot] = {}
+        self._taps: set[tuple[int, str]] = set()
+        self.stats = {"processed": 0, "merged_taps": 0, "dropped_flood": 0}
+
+    @staticmethod
+    def _key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        return update.effective_chat.id if update.effective_chat else None
+
+    async def _drop(self, update: Update, coroutine, reason: str):
+        coroutine.close()
+        self.stats[reason] += 1
+        if update.callback_query:
+            try:
+                await update.callback_query.answer("⏳ Уже обрабатываю…")
+            except Exception:
+                pass
+
+    async def do_process_update(self, update: object, coroutine):
+        uid = self._key(update)
+        if uid is None:
+            await coroutine
+            return
+        tap = None
+        if update.callback_query and update.callback_query.data:
+            tap = (uid, update.callback_query.data)
+            if tap in self._taps:
+                await self._drop(update, coroutine, "merged_taps")
+                return
+        slot = self._slots.get(uid)
+        if slot is None:
+            slot = self._slots[uid] = _UserSlot()
+        if slot.pending >= self.max_pending:
+            await self._drop(update, coroutine, "dropped_flood")
+            return
+        if tap:
+            self._taps.add(tap)
+        slot.pending += 1
+        try:
+            async with slot.lock:
+                await coroutine
+            self.stats["processed"] += 1
+        finally:
+            slot.pending -= 1
+            if not slot.pending:
+                del self._slots[uid]
+            if tap:
+                self._taps.discard(tap)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class Job:
+    __slots__ = ("id", "name", "chat_id", "state", "started_at", "finished_at", "error", "task")
+
+    def __init__(self, job_id: int, name: str, chat_id: int | None):
+        self.id = job_id
+        self.name = name
+        self.chat_id = chat_id
+        self.state = "queued"
+        self.started_at = self.finished_at = None
+        self.error = None
+        self.task = None
+
+
+class JobPool:
+    # долгие админ-задачи (начисление, компакция, выплаты) выполняются в фоне и не держат очередь апдейтов админа.
+    # Задача сама отчитывается в чат; пул следит за статусом и сообщает об ошибке. Одноимённая задача, пока
+    # предыдущая не завершилась, не запускается повторно
+    def __init__(self, bot=None, workers: int = JOB_WORKERS, history: int = JOB_HISTORY):
+        self.bot = bot
+        self._sem = asyncio.Semaphore(workers)
+        self._ids = itertools.count(1)
+        self._jobs: deque[Job] = deque(maxlen=history)
+        self._active: dict[str, Job] = {}
+
+    def submit(self, name: str, chat_id: int | None, coro_fn, *args) -> tuple[Job, bool]:
+        # -> (задача, создана ли новая)
+        job = self._active.get(name)
+        if job:
+            return job, False
+        job = Job(next(self._ids), name, chat_id)
+        self._active[name] = job
+        self._jobs.append(job)
+        job.task = asyncio.create_task(self._run(job, coro_fn, args))
+        return job, True
+
+    async def _run(self, job: Job, coro_fn, args):
+        try:
+            async with self._sem:
+                job.state = "running"
+                job.started_at = time.time()
+                await coro_fn(*args)
+                job.state = "done"
+        except asyncio.CancelledError:
+            job.state = "cancelled"
+            raise
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e)[:200]
+            log.exception("job %s #%d failed", job.name, job.id)
+            if self.bot and job.chat_id:
+                try:
+                    await self.bot.send_message(job.chat_id, f"❌ Задача #{job.id} ({job.name}) упала: {job.error}")
+                except Exception:
+                    pass
+        finally:
+            job.finished_at = time.time()
+            if self._active.get(job.name) is job:
+                del self._active[job.name]
+
+    def recent(self) -> list[Job]:
+        return list(reversed(self._jobs))
+
+    async def shutdown(self, grace: float = JOB_SHUTDOWN_GRACE):
+        # задача в потоке продолжит писать и после отмены, поэтому сначала даём ей доработать, пока БД открыта.
+        # Не успевшие отменяются: их поток упадёт на первой записи в остановленный Storage (StorageClosed),
+        # а начисление и компакция докатятся при следующем запуске
+        tasks = [j.task for j in self._active.values() if j.task]
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=grace)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+
+import httpx
+
+import metrics
+
+log = logging.getLogger("miningbot.cryptopay")
+
+API_BASE = "https://pay.crypt.bot/api"
+# сколько живёт счёт и за сколько до истечения мы перестаём его переиспользовать
+INVOICE_TTL = 3600
+REUSE_MARGIN = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices(
+    invoice_id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    package TEXT,
+    amount REAL,
+    pay_url TEXT,
+    status TEXT DEFAULT 'active',
+    created_at INTEGER,
+    expires_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_user_package ON invoices(user_id, package, status, expires_at);
+"""
+
+
+class CryptoPayError(Exception):
+    pass
+
+
+class CryptoPayUncertain(CryptoPayError):
+    # запрос мог дойти до CryptoBot и выполниться, но ответа нет: повторять неидемпотентный вызов нельзя
+    pass
+
+
+# ошибки, при которых запрос точно не ушёл на сервер
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    c.commit()
+
+
+class CryptoPayClient:
+    # один keep-alive пул на весь процесс; transport можно подменить (httpx.MockTransport,
+    # локальный стенд через base_url) для нагрузочных тестов
+    def __init__(self, token: str | None, db, base_url: str = API_BASE,
+                 transport: httpx.AsyncBaseTransport | None = None, max_connections: int = 10,
+                 max_concurrency: int = 10, retries: int = 3, backoff: float = 0.5, timeout: float = 10.0):
+        self.db = db
+        self.retries = retries
+        self.backoff = backoff
+        self._sem = asyncio.Semaphore(max_concurrency)
+        # полосатые локи: повторные нажатия одного юзера сериализуются, память не растёт с числом юзеров
+        self._locks = [asyncio.Lock() for _ in range(64)]
+        # (user_id, package), у которых createInvoice завершился без ответа: перед новым счётом ищем его у CryptoBot
+        self._unsure: set[tuple[int, str]] = set()
+        self._http = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"Crypto-Pay-API-Token": token or ""},
+            timeout=timeout,
+            transport=transport,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def call(self, method: str, payload: dict | None = None, idempotent: bool = True) -> dict:
+        # неидемпотентные методы (createInvoice) повторяются, только если запрос точно не был обработан:
+        # соединение не установлено или 429. Обрыв после отправки и 5xx дают CryptoPayUncertain
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                async with self._sem:
+                    r = await self._http.post(f"/{method}", json=payload or {})
+            except httpx.TransportError as e:
+                metrics.histogram("http_request_seconds", method=method, status="error").observe(
+                    time.perf_counter() - started)
+                err = e
+                retry = idempotent or isinstance(e, _NOT_SENT)
+            else:
+                metrics.histogram("http_request_seconds", method=method, status=str(r.status_code)).observe(
+                    time.perf_counter() - started)
+                if r.status_code != 429 and r.status_code < 500:
+                    try:
+                        j = r.json()
+                    except ValueError as e:
+                        raise CryptoPayError(f"HTTP {r.status_code}: not JSON") from e
+                    if not j.get("ok"):
+                        # ошибки API (неверный токен, параметры) повторять бессмысленно
+                        raise CryptoPayError(str(j.get("error")))
+                    return j["result"]
+                err = CryptoPayError(f"HTTP {r.status_code}")
+                retry = idempotent or r.status_code == 429
+            if not retry:
+                raise CryptoPayUncertain(str(err)) from err
+            attempt += 1
+            if attempt > self.retries:
+                raise CryptoPayError(str(err)) from err
+            delay = self.backoff * 2 ** (attempt - 1) * (1 + random.random() * 0.2)
+            log.warning("cryptopay %s failed (%s), retry %d in %.2fs", method, err, attempt, delay)
+            await asyncio.sleep(delay)
+
+    async def create_invoice(self, amount: float, description: str, payload: str, asset: str = "USDT") -> dict:
+        return await self.call("createInvoice", {
+            "asset": asset,
+            "amount": str(amount),
+            "description": description,
+            "payload": payload,
+            "expires_in": INVOICE_TTL,
+        }, idempotent=False)
+
+    async def find_active_invoice(self, payload: str) -> dict | None:
+        # счёт, созданный попыткой, ответ на которую потерялся
+        items = (await self.call("getInvoices", {"status": "active", "count": 1000}))["items"]
+        return next((i for i in items if i.get("payload") == payload and i.get("status") == "active"), None)
+
+    @staticmethod
+    def _open_invoice(c: sqlite3.Connection, user_id: int, package: str):
+        row = c.execute(
+            "SELECT invoice_id, pay_url FROM invoices WHERE user_id=? AND package=? AND status='active' AND expires_at > ? "
+            "ORDER BY created_at DESC LIMIT 1", (user_id, package, int(time.time()) + REUSE_MARGIN)).fetchone()
+        return {"invoice_id": row[0], "pay_url": row[1], "reused": True} if row else None
+
+    @staticmethod
+    def _save_invoice(c: sqlite3.Connection, invoice_id: int, user_id: int, package: str, amount: float, pay_url: str):
+        now = int(time.time())
+        c.execute("INSERT OR REPLACE INTO invoices(invoice_id, user_id, package, amount, pay_url, status, created_at, expires_at) "
+                  "VALUES(?,?,?,?,?,'active',?,?)", (invoice_id, user_id, package, amount, pay_url, now, now + INVOICE_TTL))
+
+    async def get_or_create_invoice(self, user_id: int, package: str, amount: float, description: str) -> dict:
+        # повторные нажатия по тому же пакету возвращают ещё действующий неоплаченный счёт
+        async with self._locks[hash((user_id, package)) % len(self._locks)]:
+            inv = await self.db.read(self._open_invoice, user_id, package)
+            if inv:
+                return inv
+            key, payload = (user_id, package), f"{user_id}:{package}"
+            res = await self.find_active_invoice(payload) if key in self._unsure else None
+            if res is None:
+                try:
+                    res = await self.create_invoice(amount, description, payload=payload)
+                except CryptoPayUncertain:
+                    self._unsure.add(key)
+                    raise
+            self._unsure.discard(key)
+            await self.db.write(self._save_invoice, res["invoice_id"], user_id, package, amount, res["pay_url"])
+            return {"invoice_id": res["invoice_id"], "pay_url": res["pay_url"], "reused": False}
@@ -0,0 +1,103 @@
+"""Local stand-in for pay.crypt.bot: createInvoice/getInvoices plus signed invoice_paid webhooks.
+
+    python fakecryptobot.py --port 8099 --webhook http://127.0.0.1:8080/cryptobot --pay-after 2
+
+and run the bot with CRYPTO_API_BASE=http://127.0.0.1:8099/api.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+
+import httpx
+import tornado.web
+
+from ingest import cryptobot_signature
+
+log = logging.getLogger("miningbot.fakecryptobot")
+
+
+class FakeCryptoBot:
+    def __init__(self, token: str, webhook_url: str | None = None, pay_after: float | None = None):
+        self.token = token
+        self.webhook_url = webhook_url
+        self.pay_after = pay_after
+        self.invoices: dict[int, dict] = {}
+        self._ids = itertools.count(1)
+        self._http = httpx.AsyncClient(timeout=10)
+        self.sent = 0
+
+    def create_invoice(self, params: dict) -> dict:
+        iid = next(self._ids)
+        inv = {
+            "invoice_id": iid,
+            "status": "active",
+            "asset": params.get("asset", "USDT"),
+            "amount": str(params.get("amount")),
+            "description": params.get("description"),
+            "payload": params.get("payload"),
+            "pay_url": f"https://t.me/CryptoBot?start=fake{iid}",
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+        }
+        self.invoices[iid] = inv
+        if self.pay_after is not None and self.webhook_url:
+            asyncio.get_running_loop().call_later(self.pay_after, lambda: asyncio.ensure_future(self.pay(iid)))
+        return inv
+
+    async def pay(self, invoice_id: int):
+        inv = self.invoices[invoice_id]
+        inv["status"] = "paid"
+        inv["paid_at"] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+        if not self.webhook_url:
+            return
+        body = json.dumps({"update_id": invoice_id, "update_type": "invoice_paid", "payload": inv}).encode()
+        r = await self._http.post(self.webhook_url, content=body, headers={
+            "Content-Type": "application/json",
+            "crypto-pay-api-signature": cryptobot_signature(self.token, body),
+        })
+        self.sent += 1
+        if r.status_code != 200:
+            log.warning("webhook for invoice %s -> HTTP %s", invoice_id, r.status_code)
+
+    def make_app(self) -> tornado.web.Application:
+        return tornado.web.Application([(r"/api/(\w+)", _ApiHandler, {"fake": self})])
+
+
+class _ApiHandler(tornado.web.RequestHandler):
+    def initialize(self, fake: FakeCryptoBot):
+        self.fake = fake
+
+    def post(self, method: str):
+        if self.request.headers.get("Crypto-Pay-API-Token") != self.fake.token:
+            self.write({"ok": False, "error": {"code": 401, "name": "UNAUTHORIZED"}})
+            return
+        params = json.loads(self.request.body or b"{}")
+        if method == "createInvoice":
+            self.write({"ok": True, "result": self.fake.create_invoice(params)})
+        elif method == "getInvoices":
+            ids = [int(x) for x in str(params.get("invoice_ids", "")).split(",") if x.strip().isdigit()]
+            items = [self.fake.invoices[i] for i in ids if i in self.fake.invoices] if ids else list(self.fake.invoices.values())
+            if params.get("status"):
+                items = [i for i in items if i["status"] == params["status"]]
+            self.write({"ok": True, "result": {"items": items}})
+        else:
+            self.write({"ok": False, "error": {"code": 405, "name": "METHOD_NOT_FOUND"}})
+
+
+async def _serve(args):
+    fake = FakeCryptoBot(args.token, args.webhook, args.pay_after)
+    fake.make_app().listen(args.port)
+    log.info("fake CryptoBot on :%d", args.port)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, default=8099)
+    p.add_argument("--token", default="fake-token")
+    p.add_argument("--webhook")
+    p.add_argument("--pay-after", type=float)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(p.parse_args()))
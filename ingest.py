@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import sqlite3
+import time
+
+import tornado.web
+from telegram import Update
+
+import accrual
+import metrics
+
+log = logging.getLogger("miningbot.ingest")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payments(
+    invoice_id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    package TEXT,
+    amount REAL,
+    asset TEXT,
+    paid_at INTEGER,
+    credited INTEGER DEFAULT 0
+);
+"""
+# credited: 0 — получен и ждёт воркера, 1 — начислен, -1 — отклонён.
+# body — исходный invoice из вебхука; у записей до его появления NULL, воркер их не трогает
+PENDING, CREDITED, REJECTED = 0, 1, -1
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    if "body" not in {r[1] for r in c.execute("PRAGMA table_info(payments)")}:
+        c.execute("ALTER TABLE payments ADD COLUMN body TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments(invoice_id) "
+              "WHERE credited=0 AND body IS NOT NULL")
+    c.commit()
+
+
+# --- Signatures ---
+def cryptobot_signature(token: str, body: bytes) -> str:
+    # CryptoBot: HMAC-SHA256 тела запроса, ключ — SHA256 от API-токена
+    secret = hashlib.sha256(token.encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def check_cryptobot_signature(token: str, body: bytes, signature: str | None) -> bool:
+    return bool(signature) and hmac.compare_digest(cryptobot_signature(token, body), signature)
+
+
+def default_webhook_secret(bot_token: str) -> str:
+    return hashlib.sha256(("webhook:" + bot_token).encode()).hexdigest()
+
+
+# --- Payments ---
+def parse_payload(payload: str | None) -> tuple[int | None, str]:
+    # payload счёта: "<user_id>:<package>", старые счета — просто "<user_id>"
+    uid, _, package = (payload or "").partition(":")
+    return (int(uid) if uid.isdigit() else None), (package or "10gh")
+
+
+def record_payment(c: sqlite3.Connection, inv: dict) -> bool:
+    # сырой invoice_paid сохраняется до ответа 200: после рестарта воркер докатит его из таблицы.
+    # Повторная доставка того же invoice_id ничего не добавляет
+    if inv.get("status") != "paid":
+        return False
+    uid, package = parse_payload(inv.get("payload"))
+    return c.execute("INSERT OR IGNORE INTO payments(invoice_id, user_id, package, amount, asset, paid_at, credited, body) "
+                     "VALUES(?,?,?,?,?,?,?,?)",
+                     (int(inv["invoice_id"]), uid, package, float(inv.get("amount", 0)), inv.get("asset"),
+                      int(time.time()), PENDING, json.dumps(inv))).rowcount > 0
+
+
+def _credit(c: sqlite3.Connection, invoice_ids: list[int], packages: dict, lazy: bool) -> list[tuple[int, int, float]]:
+    credited = []
+    now = int(time.time())
+    for invoice_id in invoice_ids:
+        row = c.execute("SELECT body FROM payments WHERE invoice_id=? AND credited=? AND body IS NOT NULL",
+                        (invoice_id, PENDING)).fetchone()
+        if row is None:
+            continue
+        inv = json.loads(row[0])
+        uid, package = parse_payload(inv.get("payload"))
+        pkg = packages.get(package)
+        # начисляем только по счетам, которые выставили мы сами, и только тому, кому выставили
+        issued = c.execute("SELECT user_id, package FROM invoices WHERE invoice_id=?", (invoice_id,)).fetchone()
+        ok = (uid is not None and pkg is not None and issued == (uid, package)
+              and inv.get("asset", "USDT") == "USDT" and float(inv.get("amount", 0)) >= pkg["amount"])
+        c.execute("UPDATE payments SET credited=? WHERE invoice_id=?", (CREDITED if ok else REJECTED, invoice_id))
+        c.execute("UPDATE invoices SET status='paid' WHERE invoice_id=?", (invoice_id,))
+        if not ok:
+            log.warning("payment %s not credited: %r", invoice_id, inv)
+            continue
+        accrual.add_hashrate(c, uid, pkg["hashrate"], lazy, now)
+        credited.append((uid, invoice_id, pkg["hashrate"]))
+    return credited
+
+
+def apply_payments(c: sqlite3.Connection, invoices: list[dict], packages: dict, lazy: bool) -> list[tuple[int, int, float]]:
+    # вся пачка — одна транзакция (коммитит вызывающий); уже учтённый invoice_id ничего не начисляет
+    for inv in invoices:
+        record_payment(c, inv)
+    return _credit(c, [int(inv["invoice_id"]) for inv in invoices], packages, lazy)
+
+
+def drain_payments(c: sqlite3.Connection, packages: dict, lazy: bool, limit: int) -> tuple[int, list]:
+    ids = [r[0] for r in c.execute("SELECT invoice_id FROM payments WHERE credited=? AND body IS NOT NULL "
+                                   "ORDER BY invoice_id LIMIT ?", (PENDING, limit))]
+    return len(ids), _credit(c, ids, packages, lazy)
+
+
+class PaymentWorker:
+    # вебхук пишет invoice_paid в payments и будит воркер; воркер применяет ожидающие пачками, а не по одной
+    # транзакции на платёж. Упавшая пачка откатывается и остаётся в таблице до следующей попытки
+    def __init__(self, db, packages: dict, lazy: bool, on_credited=None,
+                 batch_size: int = 500, linger: float = 0.05, retry_delay: float = 5.0):
+        self.db = db
+        self.packages = packages
+        self.lazy = lazy
+        self.on_credited = on_credited
+        self.batch_size = batch_size
+        self.linger = linger
+        self.retry_delay = retry_delay
+        self._wake = asyncio.Event()
+        self.applied = 0
+
+    async def submit(self, invoice: dict):
+        if await self.db.write(record_payment, invoice):
+            self._wake.set()
+
+    async def run(self):
+        # первый проход без ожидания: докатываем то, что пришло до рестарта
+        while True:
+            try:
+                n, credited = await self.db.write(drain_payments, self.packages, self.lazy, self.batch_size)
+            except Exception:
+                log.exception("failed to apply pending payments, retry in %.0fs", self.retry_delay)
+                await asyncio.sleep(self.retry_delay)
+                continue
+            self.applied += len(credited)
+            if credited and self.on_credited:
+                try:
+                    await self.on_credited(credited)
+                except Exception:
+                    log.exception("on_credited failed for %d payments", len(credited))
+            if n < self.batch_size:
+                await self._wake.wait()
+                self._wake.clear()
+                # немного ждём, чтобы во время всплеска оплат собрать пачку побольше
+                await asyncio.sleep(self.linger)
+
+
+# --- HTTP ---
+class TelegramHandler(tornado.web.RequestHandler):
+    def initialize(self, app, secret: str):
+        self.app = app
+        self.secret = secret
+
+    async def post(self):
+        got = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(got, self.secret):
+            raise tornado.web.HTTPError(403)
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except (ValueError, KeyError, TypeError):
+            raise tornado.web.HTTPError(400)
+        await self.app.update_queue.put(update)
+
+
+class CryptoBotHandler(tornado.web.RequestHandler):
+    def initialize(self, token: str, worker: PaymentWorker):
+        self.token = token
+        self.worker = worker
+
+    async def post(self):
+        # без токена подпись проверить нечем: маршрут закрыт, а не открыт для любых запросов
+        if not self.token:
+            raise tornado.web.HTTPError(403)
+        if not check_cryptobot_signature(self.token, self.request.body, self.request.headers.get("crypto-pay-api-signature")):
+            raise tornado.web.HTTPError(401)
+        try:
+            j = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if j.get("update_type") == "invoice_paid":
+            inv = j.get("payload")
+            if not isinstance(inv, dict) or "invoice_id" not in inv:
+                raise tornado.web.HTTPError(400)
+            # 200 только после коммита: иначе CryptoBot не повторит доставку, а платёж потеряется
+            await self.worker.submit(inv)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+
+def make_server(app, webhook_secret: str, cryptobot_token: str | None, worker: PaymentWorker,
+                telegram_path: str = "/telegram", cryptobot_path: str = "/cryptobot",
+                metrics_token: str | None = None) -> tornado.web.Application:
+    routes = [
+        (telegram_path, TelegramHandler, {"app": app, "secret": webhook_secret}),
+        (cryptobot_path, CryptoBotHandler, {"token": cryptobot_token, "worker": worker}),
+        (r"/health", HealthHandler),
+    ]
+    # порт вебхуков публичный: тексты SQL, кнопки и размеры очередей отдаём только по токену
+    if metrics_token:
+        routes.append((r"/metrics", metrics.MetricsHandler, {"token": metrics_token}))
+    return tornado.web.Application(routes)
@@ -0,0 +1,216 @@
+import csv
+import gzip
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger("miningbot.ledger")
+
+# сырые строки accruals храним RAW_DAYS, затем сворачиваем в дневные суммы; дневные старше DAILY_DAYS — в месячные
+RAW_DAYS = 35
+DAILY_DAYS = 400
+CHUNK_SIZE = 20000
+# суммы в свёртках — целые нано-USDT: перенос строк между уровнями не теряет ни одной единицы
+NANOS = 1_000_000_000
+
+SCHEMA = """
+CREATE INDEX IF NOT EXISTS idx_accruals_user_created ON accruals(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_accruals_created ON accruals(created_at);
+CREATE TABLE IF NOT EXISTS accruals_daily(
+    user_id INTEGER,
+    day TEXT,
+    amount_nanos INTEGER,
+    n INTEGER,
+    PRIMARY KEY(user_id, day)
+);
+CREATE INDEX IF NOT EXISTS idx_accruals_daily_day ON accruals_daily(day);
+CREATE TABLE IF NOT EXISTS accruals_monthly(
+    user_id INTEGER,
+    month TEXT,
+    amount_nanos INTEGER,
+    n INTEGER,
+    PRIMARY KEY(user_id, month)
+);
+"""
+
+_NANOS_SQL = f"CAST(ROUND(amount * {NANOS}) AS INTEGER)"
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    c.commit()
+
+
+def _raw_boundary(c: sqlite3.Connection, cutoff: int) -> int:
+    row = c.execute("SELECT MAX(id) FROM accruals WHERE created_at < ?", (cutoff,)).fetchone()
+    return row[0] or 0
+
+
+def _next_raw_hi(c: sqlite3.Connection, lo: int, boundary: int, chunk_size: int):
+    row = c.execute("SELECT MAX(id) FROM (SELECT id FROM accruals WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)",
+                    (lo, boundary, chunk_size)).fetchone()
+    return row[0]
+
+
+def _read_raw(c: sqlite3.Connection, lo: int, hi: int, cutoff: int):
+    return c.execute("SELECT id, user_id, amount, created_at FROM accruals WHERE id > ? AND id <= ? AND created_at < ? "
+                     "ORDER BY id", (lo, hi, cutoff)).fetchall()
+
+
+class ReconcileError(Exception):
+    pass
+
+
+def _move(c: sqlite3.Connection, table: str, key: str, removed: tuple[int, int, int], deleted: int):
+    # сверка внутри транзакции чанка: removed — (нано, n, строк), снятые с исходного уровня; в table по ключам
+    # из temp.roll должно прибавиться ровно столько же. Расхождение откатывает чанк (исключение → ROLLBACK TO job)
+    sel = (f"SELECT COALESCE(SUM(t.amount_nanos), 0), COALESCE(SUM(t.n), 0) FROM {table} t "
+           f"JOIN temp.roll r ON r.user_id = t.user_id AND r.period = t.{key}")
+    before = c.execute(sel).fetchone()
+    c.execute(f"INSERT INTO {table}(user_id, {key}, amount_nanos, n) SELECT user_id, period, amount_nanos, n "
+              f"FROM temp.roll WHERE 1 ON CONFLICT(user_id, {key}) DO UPDATE SET "
+              "amount_nanos = amount_nanos + excluded.amount_nanos, n = n + excluded.n")
+    after = c.execute(sel).fetchone()
+    added = (after[0] - before[0], after[1] - before[1])
+    if added != removed[:2] or deleted != removed[2]:
+        raise ReconcileError(f"{table}: removed {removed}, added {added}, deleted {deleted} rows")
+
+
+def _stage(c: sqlite3.Connection, select: str, args: tuple):
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS roll(user_id INTEGER, period TEXT, amount_nanos INTEGER, n INTEGER, "
+              "PRIMARY KEY(user_id, period))")
+    c.execute("DELETE FROM temp.roll")
+    c.execute(f"INSERT INTO temp.roll(user_id, period, amount_nanos, n) {select}", args)
+
+
+def _rollup_raw_chunk(c: sqlite3.Connection, lo: int, hi: int, cutoff: int) -> int:
+    # id-диапазон сворачивается и удаляется в одной транзакции; created_at < cutoff повторно
+    # проверяем на случай строк, вставленных задним числом
+    cond = "id > ? AND id <= ? AND created_at < ?"
+    args = (lo, hi, cutoff)
+    removed = c.execute(f"SELECT COALESCE(SUM({_NANOS_SQL}), 0), COUNT(*), COUNT(*) FROM accruals WHERE {cond}",
+                        args).fetchone()
+    _stage(c, f"SELECT user_id, date(created_at, 'unixepoch'), SUM({_NANOS_SQL}), COUNT(*) FROM accruals WHERE {cond} "
+              "GROUP BY user_id, date(created_at, 'unixepoch')", args)
+    deleted = c.execute(f"DELETE FROM accruals WHERE {cond}", args).rowcount
+    _move(c, "accruals_daily", "day", removed, deleted)
+    return deleted
+
+
+def _rollup_daily_chunk(c: sqlite3.Connection, cutoff_day: str, chunk_size: int) -> int:
+    rowids = f"SELECT rowid FROM accruals_daily WHERE day < ? ORDER BY rowid LIMIT {int(chunk_size)}"
+    removed = c.execute("SELECT COALESCE(SUM(amount_nanos), 0), COALESCE(SUM(n), 0), COUNT(*) FROM accruals_daily "
+                        f"WHERE rowid IN ({rowids})", (cutoff_day,)).fetchone()
+    _stage(c, f"SELECT user_id, substr(day, 1, 7), SUM(amount_nanos), SUM(n) FROM accruals_daily WHERE rowid IN ({rowids}) "
+              "GROUP BY user_id, substr(day, 1, 7)", (cutoff_day,))
+    deleted = c.execute(f"DELETE FROM accruals_daily WHERE rowid IN ({rowids})", (cutoff_day,)).rowcount
+    _move(c, "accruals_monthly", "month", removed, deleted)
+    return deleted
+
+
+def _reclaim(c: sqlite3.Connection, pages: int) -> int:
+    # работает только при auto_vacuum=INCREMENTAL; иначе освобождённые страницы просто переиспользуются
+    before = c.execute("PRAGMA freelist_count").fetchone()[0]
+    c.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return before - c.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def db_size(c: sqlite3.Connection) -> dict:
+    page_size = c.execute("PRAGMA page_size").fetchone()[0]
+    return {"bytes": c.execute("PRAGMA page_count").fetchone()[0] * page_size,
+            "free_bytes": c.execute("PRAGMA freelist_count").fetchone()[0] * page_size}
+
+
+def compact(db, now: int | None = None, archive_dir: str | None = None, raw_days: int = RAW_DAYS,
+            daily_days: int = DAILY_DAYS, chunk_size: int = CHUNK_SIZE) -> dict:
+    # онлайн-обслуживание журнала чанками через поток-писатель, бот продолжает работать.
+    # С archive_dir сырые строки перед удалением пишутся в gzip CSV потоково, по чанку.
+    # Блокирующая: вызывать через asyncio.to_thread.
+    now = int(time.time()) if now is None else now
+    started = time.perf_counter()
+    cutoff = now - raw_days * 86400
+    cutoff_day = time.strftime("%Y-%m-%d", time.gmtime(now - daily_days * 86400))
+    stats = {"raw_rows": 0, "daily_rows": 0, "archive": None, "reclaimed_pages": 0}
+    size_before = db.read_sync(db_size)
+
+    boundary = db.read_sync(_raw_boundary, cutoff)
+    gz = writer = None
+    if archive_dir and boundary:
+        os.makedirs(archive_dir, exist_ok=True)
+        stats["archive"] = os.path.join(archive_dir, time.strftime("accruals-%Y%m%d-%H%M%S.csv.gz", time.gmtime(now)))
+        gz = gzip.open(stats["archive"], "wt", newline="")
+        writer = csv.writer(gz)
+        writer.writerow(["id", "user_id", "amount", "created_at"])
+    try:
+        lo = 0
+        while True:
+            hi = db.read_sync(_next_raw_hi, lo, boundary, chunk_size)
+            if hi is None:
+                break
+            if writer:
+                writer.writerows(db.read_sync(_read_raw, lo, hi, cutoff))
+                gz.flush()
+            stats["raw_rows"] += db.write_sync(_rollup_raw_chunk, lo, hi, cutoff)
+            lo = hi
+    finally:
+        if gz:
+            gz.close()
+
+    while True:
+        n = db.write_sync(_rollup_daily_chunk, cutoff_day, chunk_size)
+        stats["daily_rows"] += n
+        if n < chunk_size:
+            break
+
+    while True:
+        n = db.maintenance_sync(_reclaim, 1000)
+        stats["reclaimed_pages"] += n
+        if n <= 0:
+            break
+    db.maintenance_sync(lambda c: c.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall())
+    size_after = db.read_sync(db_size)
+    # каждый чанк сверен в своей транзакции (_move): расхождение прервало бы компакцию с ReconcileError
+    stats["total_nanos"] = db.read_sync(total_nanos)
+    stats["bytes_before"] = size_before["bytes"]
+    stats["bytes_after"] = size_after["bytes"]
+    stats["free_bytes"] = size_after["free_bytes"]
+    stats["seconds"] = time.perf_counter() - started
+    log.info("ledger compaction: %d raw -> daily, %d daily -> monthly, %d pages reclaimed in %.2fs%s",
+             stats["raw_rows"], stats["daily_rows"], stats["reclaimed_pages"], stats["seconds"],
+             f", archived to {stats['archive']}" if stats["archive"] else "")
+    return stats
+
+
+# --- Reads ---
+def user_totals(c: sqlite3.Connection, user_id: int) -> dict:
+    # полная сумма начислений юзера по всем уровням в нано-USDT — инвариант, который не меняет компакция
+    raw = c.execute(f"SELECT COALESCE(SUM({_NANOS_SQL}), 0), COUNT(*) FROM accruals WHERE user_id=?", (user_id,)).fetchone()
+    daily = c.execute("SELECT COALESCE(SUM(amount_nanos), 0), COALESCE(SUM(n), 0) FROM accruals_daily WHERE user_id=?",
+                      (user_id,)).fetchone()
+    monthly = c.execute("SELECT COALESCE(SUM(amount_nanos), 0), COALESCE(SUM(n), 0) FROM accruals_monthly WHERE user_id=?",
+                        (user_id,)).fetchone()
+    total = raw[0] + daily[0] + monthly[0]
+    return {"raw_nanos": raw[0], "daily_nanos": daily[0], "monthly_nanos": monthly[0], "total_nanos": total,
+            "total": total / NANOS, "entries": raw[1] + daily[1] + monthly[1]}
+
+
+def total_nanos(c: sqlite3.Connection) -> int:
+    return (c.execute(f"SELECT COALESCE(SUM({_NANOS_SQL}), 0) FROM accruals").fetchone()[0]
+            + c.execute("SELECT COALESCE(SUM(amount_nanos), 0) FROM accruals_daily").fetchone()[0]
+            + c.execute("SELECT COALESCE(SUM(amount_nanos), 0) FROM accruals_monthly").fetchone()[0])
+
+
+def user_history(c: sqlite3.Connection, user_id: int, limit: int = 20) -> list[tuple[str, float]]:
+    # последние записи: сырые строки, затем дневные и месячные свёртки, от новых к старым
+    rows = c.execute("SELECT strftime('%Y-%m-%d %H:%M', created_at, 'unixepoch'), amount FROM accruals "
+                     "WHERE user_id=? ORDER BY created_at DESC LIMIT ?", (user_id, limit)).fetchall()
+    if len(rows) < limit:
+        rows += [(d, a / NANOS) for d, a in c.execute(
+            "SELECT day, amount_nanos FROM accruals_daily WHERE user_id=? ORDER BY day DESC LIMIT ?",
+            (user_id, limit - len(rows)))]
+    if len(rows) < limit:
+        rows += [(m, a / NANOS) for m, a in c.execute(
+            "SELECT month, amount_nanos FROM accruals_monthly WHERE user_id=? ORDER BY month DESC LIMIT ?",
+            (user_id, limit - len(rows)))]
+    return rows
@@ -0,0 +1,388 @@
+"""Offline load test: synthetic DB + fabricated Telegram updates against the real handlers.
+
+    BOT_TOKEN=1:sim python loadsim.py --users 100000 --updates 20000 --concurrency 64 --out results.json
+    BOT_TOKEN=1:sim python loadsim.py --db /tmp/sim.sqlite --no-seed --baseline results.json
+
+Bot API calls are answered by a stub request layer (no Telegram), CryptoBot by a local fakecryptobot.
+Updates go through the same Application/UserSerialProcessor/persistence path as in production.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import accrual
+import addresses
+import bot
+import fakecryptobot
+import metrics
+import storage
+
+log = logging.getLogger("miningbot.loadsim")
+
+ADMIN_ID = 1
+SEED_CHUNK = 5000
+WALLETS = [a for name, a in addresses.SAMPLES.items() if name != "invalid"]
+BOT_USER = {"id": 10 ** 9, "is_bot": True, "first_name": "Sim", "username": "sim_bot"}
+
+# сценарий — цепочка апдейтов одного юзера; вес — доля в смеси
+SCENARIOS = {
+    "chatter": 30,       # текст без ожидаемого ввода
+    "start": 10,         # /start нового юзера, половина — по реферальной ссылке
+    "balance": 20,
+    "income": 8,
+    "invite": 8,
+    "wallet": 6,         # 💼 Кошелёк → адрес
+    "withdraw": 6,       # 💸 Вывод → сумма
+    "buy": 5,            # счёт в fake CryptoBot
+}
+# админ один и кликает сам по себе: его сценарии идут по кругу отдельным воркером, пока идёт трафик юзеров
+ADMIN_SCENARIOS = (
+    "admin_panel",       # /admin → список, выводы, топ
+    "admin_give",        # ➕ Выдать баланс → «uid сумма»
+)
+
+
+class StubRequest(BaseRequest):
+    # HTTP-слой Bot API: отвечает как Telegram с задержкой latency, считает вызовы по методам
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self._msg_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api = url.rsplit("/", 1)[-1]
+        self.calls[api] = self.calls.get(api, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if api == "getMe":
+            result = BOT_USER
+        elif api in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = params.get("chat_id") or 0
+            result = {"message_id": params.get("message_id") or next(self._msg_ids), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER, "text": params.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# --- Seeding ---
+def _seed_users(c, lo: int, hi: int, rng: random.Random, ref_share: float, now: int, rate: float):
+    users, accruals, withdrawals = [], [], []
+    for uid in range(lo, hi):
+        ref_id = None
+        if uid > ADMIN_ID + 1 and rng.random() < ref_share:
+            # приглашают в основном недавние юзеры — получаются цепочки в глубину, а не одна звезда
+            ref_id = max(ADMIN_ID + 1, uid - int(rng.expovariate(1 / 50)) - 1)
+        hashrate = rng.choice((0, 0, 10, 10, 20, 50, 100))
+        wallet = rng.choice(WALLETS) if rng.random() < 0.5 else None
+        username = "mkru27" if uid == ADMIN_ID else f"sim{uid}"
+        users.append((uid, username, hashrate * rate * 30, hashrate, ref_id, wallet))
+        for day in range(1, 4 if hashrate else 1):
+            accruals.append((uid, hashrate * rate, now - day * 86400))
+        if wallet and rng.random() < 0.1:
+            withdrawals.append((uid, round(rng.uniform(1, 20), 2), wallet, addresses.detect_chain(wallet) or "",
+                                now - rng.randint(0, 7 * 86400)))
+    c.executemany("INSERT INTO users(id, username, balance, hashrate, ref_id, wallet) VALUES(?,?,?,?,?,?)", users)
+    c.executemany("INSERT INTO accruals(user_id, amount, created_at) VALUES(?,?,?)", accruals)
+    c.executemany("INSERT INTO withdrawals(user_id, amount, address, chain, created_at) VALUES(?,?,?,?,?)", withdrawals)
+
+
+def _finish_seed(c, lazy: bool):
+    accrual.recompute_ref_hashrate(c)
+    if lazy:
+        c.execute("UPDATE users SET acc_mark=?, last_accrued_at=?", (accrual.acc_index(), int(time.time())))
+
+
+def seed(db: storage.Storage, users: int, ref_share: float = 0.6, rng_seed: int = 1) -> dict:
+    # пачками через поток-писатель: триггеры рефералки и счётчики работают как при живой записи
+    rng = random.Random(rng_seed)
+    rate = db.get_rate_sync(bot.DEFAULT_RATE_USDT_PER_GH_PER_DAY)
+    now = int(time.time())
+    started = time.perf_counter()
+    for lo in range(1, users + 1, SEED_CHUNK):
+        db.write_sync(_seed_users, lo, min(lo + SEED_CHUNK, users + 1), rng, ref_share, now, rate)
+    db.write_sync(_finish_seed, bot.LAZY_ACCRUAL)
+    return {"users": users, "seconds": time.perf_counter() - started}
+
+
+# --- Updates ---
+class UpdateFactory:
+    def __init__(self, app, users: int, rng: random.Random):
+        self.app = app
+        self.users = users
+        self.rng = rng
+        self._update_ids = itertools.count(1)
+        self._new_ids = itertools.count(users + 1)
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": "Sim",
+                "username": "mkru27" if uid == ADMIN_ID else f"sim{uid}"}
+
+    def message(self, uid: int, text: str) -> Update:
+        msg = {"message_id": next(self._update_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": msg}, self.app.bot)
+
+    def callback(self, uid: int, data: str) -> Update:
+        msg = {"message_id": next(self._update_ids), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": BOT_USER, "text": "menu"}
+        cq = {"id": str(next(self._update_ids)), "from": self._user(uid), "chat_instance": str(uid),
+              "data": data, "message": msg}
+        return Update.de_json({"update_id": next(self._update_ids), "callback_query": cq}, self.app.bot)
+
+    def scenario(self, name: str) -> list[tuple[str, Update]]:
+        # -> [(шаг, апдейт)], шаги выполняются по порядку
+        uid = self.rng.randint(ADMIN_ID + 1, self.users)
+        if name == "chatter":
+            return [("chatter", self.message(uid, self.rng.choice(("привет", "когда выплата?", "👍"))))]
+        if name == "start":
+            new = next(self._new_ids)
+            text = f"/start {uid}" if self.rng.random() < 0.5 else "/start"
+            return [("start", self.message(new, text))]
+        if name in ("balance", "invite"):
+            return [(name, self.callback(uid, name))]
+        if name == "income":
+            return [("income", self.callback(uid, "income_info"))]
+        if name == "wallet":
+            return [("wallet", self.callback(uid, "wallet")),
+                    ("wallet_input", self.message(uid, self.rng.choice(WALLETS)))]
+        if name == "withdraw":
+            return [("withdraw", self.callback(uid, "withdraw")),
+                    ("withdraw_input", self.message(uid, str(self.rng.randint(1, 5))))]
+        if name == "buy":
+            return [("buy", self.callback(uid, "buy_hashrate"))]
+        if name == "admin_panel":
+            return [("admin", self.message(ADMIN_ID, "/admin")),
+                    ("adm_users_count", self.callback(ADMIN_ID, "adm_users_count")),
+                    ("adm_withdrawals", self.callback(ADMIN_ID, "adm_withdrawals")),
+                    ("adm_top", self.callback(ADMIN_ID, "adm_top"))]
+        if name == "admin_give":
+            return [("adm_give", self.callback(ADMIN_ID, "adm_give")),
+                    ("adm_give_input", self.message(ADMIN_ID, f"{uid} 1"))]
+        raise ValueError(name)
+
+
+def accrual_race(db: storage.Storage, chunk_size: int = 1000) -> dict:
+    # два прогона одного периода в параллельных потоках: каждый юзер с хешрейтом должен получить ровно одно начисление
+    period = f"race-{time.time_ns()}"
+    rate = db.get_rate_sync(bot.DEFAULT_RATE_USDT_PER_GH_PER_DAY)
+    expected = db.read_sync(lambda c: c.execute("SELECT COUNT(*) FROM users WHERE hashrate > 0").fetchone()[0])
+    results = [None, None]
+
+    def one(i):
+        results[i] = accrual.run_accrual(db.write_sync, rate, period=period, chunk_size=chunk_size)
+
+    threads = [threading.Thread(target=one, args=(i,)) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    paid = sum(r["rows"] for r in results)
+    return {"period": period, "expected": expected, "paid": paid, "ok": paid == expected}
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+
+    def pct(p):
+        return v[min(len(v) - 1, int(p / 100 * len(v)))] * 1000
+
+    return {"n": len(v), "p50_ms": pct(50), "p95_ms": pct(95), "p99_ms": pct(99), "max_ms": v[-1] * 1000,
+            "mean_ms": sum(v) / len(v) * 1000}
+
+
+async def drive(app, factory: UpdateFactory, updates: int, concurrency: int, mix: dict[str, int],
+                with_admin: bool = True) -> dict:
+    names, weights = list(mix), list(mix.values())
+    timings: dict[str, list[float]] = {}
+    errors = 0
+    sent = 0
+    processor = app.update_processor
+    done = False
+
+    async def run_steps(steps):
+        nonlocal errors
+        for step, update in steps:
+            started = time.perf_counter()
+            try:
+                await processor.process_update(update, app.process_update(update))
+            except Exception:
+                errors += 1
+                log.exception("update %s failed", step)
+            timings.setdefault(step, []).append(time.perf_counter() - started)
+
+    async def worker():
+        nonlocal sent
+        while sent < updates:
+            steps = factory.scenario(factory.rng.choices(names, weights)[0])
+            sent += len(steps)
+            await run_steps(steps)
+
+    async def admin_worker():
+        for name in itertools.cycle(ADMIN_SCENARIOS):
+            if done:
+                return
+            await run_steps(factory.scenario(name))
+
+    started = time.perf_counter()
+    admin = asyncio.create_task(admin_worker()) if with_admin else None
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    done = True
+    if admin:
+        await admin
+    elapsed = time.perf_counter() - started
+    everything = [t for ts in timings.values() for t in ts]
+    return {"updates": len(everything), "errors": errors, "seconds": elapsed,
+            "updates_per_sec": len(everything) / elapsed if elapsed > 0 else 0.0,
+            "latency": percentiles(everything),
+            "by_step": {step: percentiles(ts) for step, ts in sorted(timings.items())}}
+
+
+def db_bytes(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+async def run(args) -> dict:
+    path = args.db or os.path.join(tempfile.mkdtemp(), "loadsim.sqlite")
+    fresh = not os.path.exists(path)
+    bot.db = storage.Storage(path, bot.ADMIN_USERNAMES, bot.LAZY_ACCRUAL)
+    bot.init_db()
+    result = {"config": {k: v for k, v in vars(args).items() if k != "out"}, "db": path,
+              "accrual_mode": bot.ACCRUAL_MODE, "started_at": int(time.time())}
+    if fresh and not args.no_seed:
+        result["seed"] = await asyncio.to_thread(seed, bot.db, args.users, args.ref_share, args.seed)
+        log.info("seeded %d users in %.1fs", args.users, result["seed"]["seconds"])
+    users = bot.db.read_sync(lambda c: c.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0])
+    if users <= ADMIN_ID + 1:
+        raise SystemExit("empty DB: run without --no-seed or point --db at a seeded file")
+
+    fake = fakecryptobot.FakeCryptoBot("loadsim")
+    fake_server = fake.make_app().listen(args.fake_port, address="127.0.0.1")
+    bot.CRYPTO_API_BASE = f"http://127.0.0.1:{args.fake_port}/api"
+    bot.CRYPTOBOT_TOKEN = "loadsim"
+
+    request = StubRequest(args.latency)
+    app = bot.build_app(os.getenv("BOT_TOKEN") or "1:loadsim", request=request)
+    await app.initialize()
+    await bot.on_startup(app)
+    await app.start()
+    try:
+        factory = UpdateFactory(app, users, random.Random(args.seed))
+        result["traffic"] = await drive(app, factory, args.updates, args.concurrency, SCENARIOS, not args.no_admin)
+        if args.accrual_race and not bot.LAZY_ACCRUAL:
+            result["accrual_race"] = await asyncio.to_thread(accrual_race, bot.db)
+        if not bot.LAZY_ACCRUAL:
+            # без дайджестов: в бенчмарке важна только стоимость прохода по таблице
+            result["accrual"] = await asyncio.to_thread(bot.do_daily_accrual)
+    finally:
+        await app.stop()
+        fake_server.stop()
+        # как run_polling: post_shutdown после app.shutdown, чтобы финальный сброс persistence застал писателя
+        await app.shutdown()
+        await bot.on_shutdown(app)
+    result["bot_api_calls"] = request.calls
+    result["processor"] = dict(bot.processor.stats)
+    result["user_cache"] = bot.db.cache.stats()
+    result["sql_top"] = [{"stmt": labels["stmt"], "count": h.count, "seconds": h.sum}
+                         for labels, h in metrics.top("sql_seconds", 10)]
+    result["db_bytes"] = db_bytes(path)
+    return result
+
+
+def compare(result: dict, baseline: dict) -> list[str]:
+    lines = []
+
+    def row(name, new, old, better_lower=True):
+        if old:
+            delta = (new - old) / old * 100
+            worse = delta > 0 if better_lower else delta < 0
+            lines.append(f"{name:28} {old:12.2f} → {new:12.2f}  {delta:+6.1f}%{'  ⚠' if worse and abs(delta) > 10 else ''}")
+
+    row("updates/s", result["traffic"]["updates_per_sec"], baseline["traffic"]["updates_per_sec"], better_lower=False)
+    for p in ("p50_ms", "p95_ms", "p99_ms"):
+        row(f"latency {p}", result["traffic"]["latency"][p], baseline["traffic"]["latency"].get(p))
+    for step, st in result["traffic"]["by_step"].items():
+        old = baseline["traffic"]["by_step"].get(step)
+        if old:
+            row(f"{step} p95_ms", st["p95_ms"], old.get("p95_ms"))
+    if "accrual" in result and "accrual" in baseline and not result["accrual"].get("already_done"):
+        row("accrual seconds", result["accrual"]["seconds"], baseline["accrual"].get("seconds"))
+    row("db MB", result["db_bytes"] / 2 ** 20, baseline["db_bytes"] / 2 ** 20)
+    return lines
+
+
+def report(result: dict) -> list[str]:
+    t = result["traffic"]
+    lines = [f"{t['updates']} updates in {t['seconds']:.1f}s: {t['updates_per_sec']:.0f} upd/s, {t['errors']} errors",
+             f"latency p50 {t['latency']['p50_ms']:.1f} ms, p95 {t['latency']['p95_ms']:.1f} ms, "
+             f"p99 {t['latency']['p99_ms']:.1f} ms"]
+    for step, st in t["by_step"].items():
+        lines.append(f"  {step:18} {st['n']:7}  p50 {st['p50_ms']:7.1f}  p95 {st['p95_ms']:7.1f}  p99 {st['p99_ms']:7.1f} ms")
+    race = result.get("accrual_race")
+    if race:
+        lines.append(f"accrual race: {race['paid']} paid / {race['expected']} expected — {'ok' if race['ok'] else 'DOUBLE PAY'}")
+    acc = result.get("accrual")
+    if acc:
+        if acc.get("already_done"):
+            lines.append(f"accrual {acc['period']}: already done")
+        else:
+            lines.append(f"accrual {acc['period']}: {acc['rows']} rows in {acc['seconds']:.2f}s "
+                         f"({acc['rows_per_sec']:.0f} rows/s)")
+    lines.append(f"db {result['db_bytes'] / 2 ** 20:.1f} MB, processor {result['processor']}")
+    return lines
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--users", type=int, default=100000)
+    p.add_argument("--ref-share", type=float, default=0.6, help="доля юзеров, пришедших по рефссылке")
+    p.add_argument("--updates", type=int, default=20000)
+    p.add_argument("--concurrency", type=int, default=64, help="одновременных виртуальных юзеров")
+    p.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    p.add_argument("--db", help="файл БД; по умолчанию новый во временном каталоге")
+    p.add_argument("--no-seed", action="store_true")
+    p.add_argument("--no-admin", action="store_true", help="без параллельных кликов админа")
+    p.add_argument("--accrual-race", action="store_true", help="проверить, что два параллельных прогона не платят дважды")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--fake-port", type=int, default=18099)
+    p.add_argument("--out", default=f"loadsim-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    p.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    args = p.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    log.setLevel(logging.INFO)
+    res = asyncio.run(run(args))
+    print("\n".join(report(res)))
+    if args.baseline:
+        with open(args.baseline) as fh:
+            print("\n".join(["", "vs " + args.baseline] + compare(res, json.load(fh))))
+    with open(args.out, "w") as fh:
+        json.dump(res, fh, ensure_ascii=False, indent=2)
+    print(f"saved {args.out}")
+    if not res.get("accrual_race", {}).get("ok", True):
+        raise SystemExit(1)
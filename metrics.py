@@ -0,0 +1,239 @@
+import functools
+import hmac
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+import tornado.web
+
+# гистограммы в секундах: от доли миллисекунды (SQL) до минут (начисление, компакция)
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    # запись — bisect и три инкремента под своим локом; без аллокаций на горячем пути
+    __slots__ = ("counts", "sum", "count", "_lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, v: float):
+        i = bisect_left(BUCKETS, v)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += v
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # верхняя граница корзины, в которую попадает квантиль
+        need = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= need and n:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return 0.0
+
+
+_lock = threading.Lock()
+_histograms: dict[tuple[str, tuple], Histogram] = {}
+_counters: dict[tuple[str, tuple], float] = {}
+_gauges: dict[tuple[str, tuple], float] = {}
+_gauge_fns: dict[str, object] = {}
+HELP = {
+    "handler_seconds": "Telegram handler latency",
+    "callback_seconds": "Latency per callback_data (digits collapsed)",
+    "handler_errors_total": "Handler exceptions",
+    "sql_seconds": "Per-statement SQLite execute time",
+    "db_job_seconds": "Storage job execution time (without queueing)",
+    "db_commit_seconds": "Writer group commit time",
+    "http_request_seconds": "Outbound CryptoBot API calls",
+    "accrual_seconds": "Batch accrual run duration",
+}
+
+
+def histogram(name: str, **labels) -> Histogram:
+    key = (name, tuple(sorted(labels.items())))
+    h = _histograms.get(key)
+    if h is None:
+        with _lock:
+            h = _histograms.setdefault(key, Histogram())
+    return h
+
+
+def inc(name: str, value: float = 1.0, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def gauge_fn(name: str, fn):
+    # значение снимается при выдаче метрик (длина очереди писателя, размер кэша и т.п.)
+    _gauge_fns[name] = fn
+
+
+# --- Instrumentation ---
+_DIGITS = re.compile(r"\d+")
+
+
+def instrument(fn):
+    # обёртка хендлера PTB: латентность по имени хендлера и по callback_data (числа схлопнуты в #)
+    h = histogram("handler_seconds", handler=fn.__name__)
+
+    @functools.wraps(fn)
+    async def wrapper(update, context, *args):
+        started = time.perf_counter()
+        try:
+            return await fn(update, context, *args)
+        except Exception:
+            inc("handler_errors_total", handler=fn.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            h.observe(elapsed)
+            q = getattr(update, "callback_query", None)
+            if q is not None and q.data:
+                histogram("callback_seconds", data=_DIGITS.sub("#", q.data)).observe(elapsed)
+    return wrapper
+
+
+_sql_hist: dict[str, Histogram] = {}
+# запросы с переменным числом плейсхолдеров дают новые тексты; сверх лимита всё идёт в stmt="other"
+MAX_SQL_LABELS = 500
+
+
+def _sql_histogram(sql: str) -> Histogram:
+    h = _sql_hist.get(sql)
+    if h is None:
+        stmt = " ".join(sql.split())[:120] if len(_sql_hist) < MAX_SQL_LABELS else "other"
+        h = _sql_hist[sql] = histogram("sql_seconds", stmt=stmt)
+    return h
+
+
+class TimedConnection(sqlite3.Connection):
+    # factory для sqlite3.connect: время execute/executemany по тексту запроса (шаг до первой строки
+    # для SELECT; fetch остальных строк учитывается в db_job_seconds)
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            _sql_histogram(sql).observe(time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            _sql_histogram(sql).observe(time.perf_counter() - started)
+
+
+def job_name(fn) -> str:
+    return f"{getattr(fn, '__module__', '?')}.{getattr(fn, '__qualname__', type(fn).__name__)}"
+
+
+# --- Output ---
+def _esc(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(labels: tuple, le: str | None = None) -> str:
+    parts = [f'{k}="{_esc(v)}"' for k, v in labels]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render() -> str:
+    # Prometheus text exposition format 0.0.4
+    out = []
+    seen = set()
+
+    def header(name: str, kind: str):
+        if name not in seen:
+            seen.add(name)
+            if name in HELP:
+                out.append(f"# HELP {name} {HELP[name]}")
+            out.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), h in sorted(_histograms.items()):
+        header(name, "histogram")
+        with h._lock:
+            counts, total, count = list(h.counts), h.sum, h.count
+        cum = 0
+        for le, n in zip(BUCKETS, counts):
+            cum += n
+            out.append(f"{name}_bucket{_fmt_labels(labels, str(le))} {cum}")
+        out.append(f"{name}_bucket{_fmt_labels(labels, '+Inf')} {count}")
+        out.append(f"{name}_sum{_fmt_labels(labels)} {total}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {count}")
+    for (name, labels), v in sorted(_counters.items()):
+        header(name, "counter")
+        out.append(f"{name}{_fmt_labels(labels)} {v}")
+    gauges = dict(_gauges)
+    for name, fn in _gauge_fns.items():
+        try:
+            gauges[(name, ())] = float(fn())
+        except Exception:
+            continue
+    for (name, labels), v in sorted(gauges.items()):
+        header(name, "gauge")
+        out.append(f"{name}{_fmt_labels(labels)} {v}")
+    return "\n".join(out) + "\n"
+
+
+def top(name: str, limit: int = 5, by: str = "sum") -> list[tuple[dict, Histogram]]:
+    rows = [(dict(labels), h) for (n, labels), h in list(_histograms.items()) if n == name and h.count]
+    rows.sort(key=lambda r: r[1].sum if by == "sum" else r[1].quantile(0.95), reverse=True)
+    return rows[:limit]
+
+
+def summary(limit: int = 5) -> str:
+    # короткая сводка для админки: самые медленные хендлеры, кнопки, запросы и внешние вызовы
+    def ms(v):
+        return f"{v * 1000:.1f}"
+
+    lines = ["📊 Статистика (с запуска):"]
+    for title, name, key, by in (("Хендлеры", "handler_seconds", "handler", "p95"),
+                                 ("Кнопки", "callback_seconds", "data", "p95"),
+                                 ("SQL (по суммарному времени)", "sql_seconds", "stmt", "sum"),
+                                 ("CryptoBot API", "http_request_seconds", "method", "sum")):
+        rows = top(name, limit, by)
+        if not rows:
+            continue
+        lines.append(f"\n{title}:")
+        for labels, h in rows:
+            label = labels.get(key, "?")[:60]
+            lines.append(f"• {label}: {h.count}× avg {ms(h.sum / h.count)} мс, p95 ≤ {ms(h.quantile(0.95))} мс, "
+                         f"всего {h.sum:.2f} с")
+    h = _histograms.get(("accrual_seconds", ()))
+    if h and h.count:
+        lines.append(f"\nНачисление: {h.count} прогонов, последний {_gauges.get(('accrual_last_rows', ()), 0):.0f} строк, "
+                     f"{_gauges.get(('accrual_last_rows_per_sec', ()), 0):.0f} строк/с")
+    return "\n".join(lines)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, token: str | None = None):
+        self.token = token
+
+    def get(self):
+        if self.token:
+            got = self.get_query_argument("token", "") or self.request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if not hmac.compare_digest(got, self.token):
+                raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(render())
+
+
+def make_app(token: str | None = None) -> tornado.web.Application:
+    return tornado.web.Application([(r"/metrics", MetricsHandler, {"token": token})])
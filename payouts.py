@@ -0,0 +1,212 @@
+import csv
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import time
+from collections import Counter
+
+import accrual
+
+log = logging.getLogger("miningbot.payouts")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payout_batches(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at INTEGER,
+    filter TEXT,
+    approved INTEGER DEFAULT 0,
+    total REAL DEFAULT 0,
+    skipped INTEGER DEFAULT 0
+);
+"""
+# chain: метка сети из detect_chain на момент создания заявки ('' — адрес не прошёл проверку, NULL — ещё не проверен)
+WITHDRAWAL_COLUMNS = {"chain": "TEXT", "batch_id": "INTEGER"}
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_withdrawals_batch ON withdrawals(batch_id, id);
+CREATE INDEX IF NOT EXISTS idx_withdrawals_status_chain ON withdrawals(status, chain, id);
+"""
+MAX_BATCH = 50000
+CHUNK_SIZE = 2000
+# сколько отказов показывать админу поимённо
+FAILURE_SAMPLE = 10
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    have = {r[1] for r in c.execute("PRAGMA table_info(withdrawals)")}
+    for col, decl in WITHDRAWAL_COLUMNS.items():
+        if col not in have:
+            c.execute(f"ALTER TABLE withdrawals ADD COLUMN {col} {decl}")
+    c.executescript(INDEXES)
+    c.commit()
+
+
+# --- Filter ---
+_AGE_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+
+def parse_filter(args: list[str]) -> dict:
+    # /payout chain=tron min=5 max=100 older=24h limit=1000 fmt=jsonl
+    f = {"chain": None, "min": None, "max": None, "older": 0, "limit": MAX_BATCH, "fmt": "csv"}
+    for arg in args:
+        k, sep, v = arg.partition("=")
+        if not sep:
+            raise ValueError(arg)
+        k = k.lower()
+        if k == "chain":
+            f["chain"] = v.lower()
+        elif k in ("min", "max"):
+            f[k] = float(v.replace(",", "."))
+            if not math.isfinite(f[k]):
+                raise ValueError(arg)
+        elif k == "older":
+            m = re.fullmatch(r"(\d+)([mhd])", v.lower())
+            if not m:
+                raise ValueError(arg)
+            f["older"] = int(m.group(1)) * _AGE_UNITS[m.group(2)]
+        elif k == "limit":
+            f["limit"] = min(int(v), MAX_BATCH)
+        elif k == "fmt" and v.lower() in ("csv", "jsonl"):
+            f["fmt"] = v.lower()
+        else:
+            raise ValueError(arg)
+    return f
+
+
+def describe_filter(f: dict) -> str:
+    parts = []
+    if f["chain"]:
+        parts.append(f"сеть {f['chain']}*")
+    if f["min"] is not None:
+        parts.append(f"≥ {f['min']:g} USDT")
+    if f["max"] is not None:
+        parts.append(f"≤ {f['max']:g} USDT")
+    if f["older"]:
+        parts.append(f"старше {f['older'] // 3600} ч" if f["older"] >= 3600 else f"старше {f['older'] // 60} мин")
+    return ", ".join(parts) or "все ожидающие"
+
+
+def _where(f: dict, now: int) -> tuple[str, list]:
+    sql = ["status='pending'"]
+    args: list = []
+    if f["chain"]:
+        sql.append("chain LIKE ?")
+        args.append(f["chain"] + "%")
+    if f["min"] is not None:
+        sql.append("amount >= ?")
+        args.append(f["min"])
+    if f["max"] is not None:
+        sql.append("amount <= ?")
+        args.append(f["max"])
+    if f["older"]:
+        sql.append("created_at <= ?")
+        args.append(now - f["older"])
+    return " AND ".join(sql), args
+
+
+# --- Pipeline ---
+def backfill_chains(c: sqlite3.Connection, detect, limit: int = CHUNK_SIZE) -> int:
+    # старые заявки без chain: проставляем по адресу, чтобы фильтр по сети работал в SQL
+    rows = c.execute("SELECT id, address FROM withdrawals WHERE status='pending' AND chain IS NULL LIMIT ?", (limit,)).fetchall()
+    c.executemany("UPDATE withdrawals SET chain=? WHERE id=?", [(detect(addr or "") or "", wid) for wid, addr in rows])
+    return len(rows)
+
+
+def backfill_all(db, detect):
+    # блокирующая, чанками через писателя
+    while db.write_sync(backfill_chains, detect) == CHUNK_SIZE:
+        pass
+
+
+def preview(c: sqlite3.Connection, f: dict, now: int) -> tuple[int, float]:
+    where, args = _where(f, now)
+    n, total = c.execute(f"SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM "
+                         f"(SELECT amount FROM withdrawals WHERE {where} ORDER BY id LIMIT ?)", (*args, f["limit"])).fetchone()
+    return n, total
+
+
+def approve_batch(c: sqlite3.Connection, f: dict, now: int, lazy: bool) -> dict:
+    # одна транзакция: проверка каждой заявки, списание и отметка approved; не прошедшие остаются pending
+    where, args = _where(f, now)
+    rows = c.execute(f"SELECT id, user_id, amount, chain FROM withdrawals WHERE {where} ORDER BY id LIMIT ?",
+                     (*args, f["limit"])).fetchall()
+    batch_id = c.execute("INSERT INTO payout_batches(created_at, filter) VALUES(?,?)", (now, json.dumps(f))).lastrowid
+    failures: Counter = Counter()
+    sample = []
+    settled = set()
+    approved = 0
+    total = 0.0
+    for wid, uid, amount, chain in rows:
+        reason = None
+        if not chain:
+            reason = "invalid_address"
+        elif amount is None or amount <= 0:
+            reason = "bad_amount"
+        else:
+            if lazy and uid not in settled:
+                accrual.settle(c, uid, now)
+                settled.add(uid)
+            if c.execute("UPDATE users SET balance = balance - ? WHERE id=? AND balance >= ?", (amount, uid, amount)).rowcount != 1:
+                reason = "insufficient_balance"
+        if reason:
+            failures[reason] += 1
+            if len(sample) < FAILURE_SAMPLE:
+                sample.append((wid, reason))
+            continue
+        c.execute("UPDATE withdrawals SET status='approved', batch_id=? WHERE id=?", (batch_id, wid))
+        approved += 1
+        total += amount
+    c.execute("UPDATE payout_batches SET approved=?, total=?, skipped=? WHERE id=?",
+              (approved, total, len(rows) - approved, batch_id))
+    return {"batch_id": batch_id, "selected": len(rows), "approved": approved, "total": total,
+            "failures": dict(failures), "sample": sample}
+
+
+def _batch_chunk(c: sqlite3.Connection, batch_id: int, after: int, limit: int):
+    return c.execute("SELECT w.id, w.user_id, u.username, w.chain, w.address, w.amount, w.created_at "
+                     "FROM withdrawals w LEFT JOIN users u ON u.id = w.user_id "
+                     "WHERE w.batch_id=? AND w.id > ? ORDER BY w.id LIMIT ?", (batch_id, after, limit)).fetchall()
+
+
+EXPORT_FIELDS = ["withdrawal_id", "user_id", "username", "chain", "address", "amount", "created_at"]
+
+
+def export_batch(db, batch_id: int, out_dir: str, fmt: str = "csv", chunk_size: int = CHUNK_SIZE) -> tuple[str, int]:
+    # потоковая выгрузка: keyset-чанки из читателя сразу пишутся в файл, память не растёт с размером пачки.
+    # Блокирующая: вызывать через asyncio.to_thread.
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"payout-{batch_id}.{fmt}")
+    n = 0
+    with open(path, "w", newline="", encoding="utf-8") as fh:
+        w = csv.writer(fh) if fmt == "csv" else None
+        if w:
+            w.writerow(EXPORT_FIELDS)
+        after = 0
+        while True:
+            rows = db.read_sync(_batch_chunk, batch_id, after, chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                if w:
+                    w.writerow(row)
+                else:
+                    fh.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + "\n")
+            n += len(rows)
+            after = rows[-1][0]
+    return path, n
+
+
+def run_batch(db, f: dict, detect, out_dir: str) -> dict:
+    # весь конвейер: добор chain для старых заявок, атомарное одобрение, выгрузка файла выплат
+    started = time.perf_counter()
+    now = int(time.time())
+    backfill_all(db, detect)
+    res = db.write_sync(approve_batch, f, now, db.lazy)
+    res["path"], res["exported"] = export_batch(db, res["batch_id"], out_dir, f["fmt"])
+    res["seconds"] = time.perf_counter() - started
+    log.info("payout batch %d: %d/%d approved, %.2f USDT, %s in %.2fs", res["batch_id"], res["approved"], res["selected"],
+             res["total"], res["failures"], res["seconds"])
+    return res
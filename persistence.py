@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+log = logging.getLogger("miningbot.persistence")
+
+# как часто Application сбрасывает изменённые user_data
+UPDATE_INTERVAL = 5.0
+# сколько юзеров помним в _loaded/_written (LRU); вытесненный при следующем апдейте просто перечитывается
+MAX_TRACKED = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_state(
+    user_id INTEGER PRIMARY KEY,
+    data TEXT,
+    updated_at INTEGER
+);
+"""
+
+
+def init_schema(c: sqlite3.Connection):
+    c.executescript(SCHEMA)
+    c.commit()
+
+
+def _load(c: sqlite3.Connection, user_id: int):
+    row = c.execute("SELECT data FROM user_state WHERE user_id=?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _remember(d: OrderedDict, key: int, value):
+    d[key] = value
+    d.move_to_end(key)
+    if len(d) > MAX_TRACKED:
+        d.popitem(last=False)
+
+
+def _save(c: sqlite3.Connection, rows: list[tuple[int, str | None]]):
+    now = int(time.time())
+    c.executemany("INSERT INTO user_state(user_id, data, updated_at) VALUES(?,?,?) "
+                  "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                  [(uid, data, now) for uid, data in rows if data is not None])
+    c.executemany("DELETE FROM user_state WHERE user_id=?", [(uid,) for uid, data in rows if data is None])
+
+
+class SQLitePersistence(BasePersistence):
+    # user_data в таблице user_state той же БД (через поток-писатель Storage).
+    # Старт не читает ничего: состояние юзера подгружается при его первом апдейте (refresh_user_data).
+    # На каждом цикле Application.update_persistence пишутся только реально изменившиеся юзеры,
+    # все одной транзакцией. Значения должны сериализоваться в JSON (флаги ввода, числа, фильтр выплат)
+    def __init__(self, db, update_interval: float = UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(user_data=True, chat_data=False, bot_data=False,
+                                                     callback_data=False), update_interval=update_interval)
+        self.db = db
+        self._loaded: OrderedDict[int, None] = OrderedDict()
+        # хеш последнего записанного состояния — чтобы не писать неизменившиеся строки
+        self._written: OrderedDict[int, int] = OrderedDict()
+        self._dirty: dict[int, str | None] = {}
+        self._flush: asyncio.Future | None = None
+        self.stats = {"loaded": 0, "written": 0, "flushes": 0}
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id in self._loaded:
+            self._loaded.move_to_end(user_id)
+            return
+        _remember(self._loaded, user_id, None)
+        if user_data:
+            # юзер был вытеснен из _loaded, но его состояние в памяти свежее, чем в БД
+            return
+        data = await self.db.read(_load, user_id)
+        # без строки в БД пустой user_data тоже считается записанным, иначе первый сброс сделает лишний DELETE
+        _remember(self._written, user_id, hash(data))
+        if data:
+            # в памяти ещё ничего нет: это первый апдейт юзера после старта
+            for k, v in json.loads(data).items():
+                user_data.setdefault(k, v)
+            self.stats["loaded"] += 1
+
+    async def update_user_data(self, user_id: int, data: dict):
+        blob = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        if self._written.get(user_id) == hash(blob):
+            return
+        self._dirty[user_id] = blob
+        # Application вызывает update_user_data для всех изменённых юзеров разом через gather:
+        # первый вызов планирует общую запись, которая стартует после того, как остальные добавят свои строки
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._write_dirty())
+        await asyncio.shield(self._flush)
+
+    async def drop_user_data(self, user_id: int):
+        self._dirty[user_id] = None
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        self._flush = None
+        rows = list(self._dirty.items())
+        self._dirty.clear()
+        if not rows:
+            return
+        await self.db.write(_save, rows)
+        for uid, blob in rows:
+            _remember(self._written, uid, hash(blob))
+        self.stats["written"] += len(rows)
+        self.stats["flushes"] += 1
+
+    async def flush(self):
+        await self._write_dirty()
+
+    # чаты, bot_data, callback_data и ConversationHandler не используются
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
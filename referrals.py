@@ -0,0 +1,133 @@
+import json
+import logging
+import sqlite3
+import time
+
+import accrual
+
+log = logging.getLogger("miningbot.referrals")
+
+# глубина замыкания: предки дальше MAX_DEPTH не хранятся и бонусов не получают
+MAX_DEPTH = 5
+# уровни до введения графа: только прямой реферер, 1%
+LEGACY_LEVELS = [0.01]
+
+# ref_closure — все пары (предок, потомок) до MAX_DEPTH, ref_stats — агрегаты по рефереру.
+# Оба ведут триггеры на users, поэтому их обновляет любой путь записи (ensure_user, покупка, выдача хешрейта).
+# users.ref_hashrate — бонусный хешрейт потомков, взвешенный процентами уровней (для lazy-режима).
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS ref_closure(
+    descendant INTEGER,
+    depth INTEGER,
+    ancestor INTEGER,
+    PRIMARY KEY(descendant, depth)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_ref_closure_ancestor ON ref_closure(ancestor, depth);
+CREATE TABLE IF NOT EXISTS ref_stats(
+    user_id INTEGER PRIMARY KEY,
+    direct INTEGER NOT NULL DEFAULT 0,
+    indirect INTEGER NOT NULL DEFAULT 0,
+    bonus REAL NOT NULL DEFAULT 0,
+    downstream_hashrate REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_ref_stats_bonus ON ref_stats(bonus);
+CREATE TABLE IF NOT EXISTS ref_levels(
+    depth INTEGER PRIMARY KEY,
+    pct REAL
+);
+CREATE TRIGGER IF NOT EXISTS ref_users_ins AFTER INSERT ON users
+WHEN NEW.ref_id IS NOT NULL AND NEW.ref_id <> 0 AND NEW.ref_id <> NEW.id
+BEGIN
+    INSERT OR IGNORE INTO ref_closure(descendant, depth, ancestor) VALUES(NEW.id, 1, NEW.ref_id);
+    INSERT OR IGNORE INTO ref_closure(descendant, depth, ancestor)
+        SELECT NEW.id, depth + 1, ancestor FROM ref_closure
+        WHERE descendant = NEW.ref_id AND depth < {MAX_DEPTH} AND ancestor <> NEW.id;
+    INSERT OR IGNORE INTO ref_stats(user_id) SELECT ancestor FROM ref_closure WHERE descendant = NEW.id;
+    UPDATE ref_stats SET direct = direct + (user_id = NEW.ref_id), indirect = indirect + (user_id <> NEW.ref_id),
+        downstream_hashrate = downstream_hashrate + NEW.hashrate
+    WHERE user_id IN (SELECT ancestor FROM ref_closure WHERE descendant = NEW.id);
+END;
+CREATE TRIGGER IF NOT EXISTS ref_users_hashrate AFTER UPDATE OF hashrate ON users
+WHEN NEW.hashrate IS NOT OLD.hashrate
+BEGIN
+    UPDATE ref_stats SET downstream_hashrate = downstream_hashrate + NEW.hashrate - OLD.hashrate
+    WHERE user_id IN (SELECT ancestor FROM ref_closure WHERE descendant = NEW.id);
+    UPDATE users SET ref_hashrate = ref_hashrate + (NEW.hashrate - OLD.hashrate) * (
+        SELECT SUM(l.pct) FROM ref_closure cl JOIN ref_levels l ON l.depth = cl.depth
+        WHERE cl.descendant = NEW.id AND cl.ancestor = users.id)
+    WHERE id IN (SELECT cl.ancestor FROM ref_closure cl JOIN ref_levels l ON l.depth = cl.depth WHERE cl.descendant = NEW.id);
+END;
+"""
+
+
+def init_schema(c: sqlite3.Connection):
+    # нужен users.ref_hashrate: вызывать после accrual.init_lazy_schema
+    c.executescript(SCHEMA)
+    row = c.execute("SELECT v FROM settings WHERE k='ref_graph_depth'").fetchone()
+    if row is None or int(row[0]) != MAX_DEPTH:
+        _rebuild(c)
+        c.execute("INSERT INTO settings(k,v) VALUES('ref_graph_depth', ?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+                  (str(MAX_DEPTH),))
+    c.commit()
+
+
+def _rebuild(c: sqlite3.Connection):
+    # разовое построение по users.ref_id: MAX_DEPTH set-based проходов. Заработанный bonus сохраняется
+    c.execute("DELETE FROM ref_closure")
+    c.execute("INSERT INTO ref_closure(descendant, depth, ancestor) "
+              "SELECT id, 1, ref_id FROM users WHERE ref_id IS NOT NULL AND ref_id <> 0 AND ref_id <> id")
+    for depth in range(2, MAX_DEPTH + 1):
+        c.execute("INSERT OR IGNORE INTO ref_closure(descendant, depth, ancestor) "
+                  "SELECT cl.descendant, ?, p.ancestor FROM ref_closure cl "
+                  "JOIN ref_closure p ON p.descendant = cl.ancestor AND p.depth = 1 "
+                  "WHERE cl.depth = ? AND p.ancestor <> cl.descendant", (depth, depth - 1))
+    c.execute("UPDATE ref_stats SET direct=0, indirect=0, downstream_hashrate=0")
+    c.execute("INSERT INTO ref_stats(user_id, direct, indirect, downstream_hashrate) "
+              "SELECT cl.ancestor, SUM(cl.depth = 1), SUM(cl.depth > 1), SUM(u.hashrate) "
+              "FROM ref_closure cl JOIN users u ON u.id = cl.descendant WHERE 1 GROUP BY cl.ancestor "
+              "ON CONFLICT(user_id) DO UPDATE SET direct=excluded.direct, indirect=excluded.indirect, "
+              "downstream_hashrate=excluded.downstream_hashrate")
+    log.info("referral graph built: %d closure rows", c.execute("SELECT COUNT(*) FROM ref_closure").fetchone()[0])
+
+
+def set_levels(c: sqlite3.Connection, levels: list[float]):
+    # levels[i] — доля дохода потомка на уровне i+1, которую получает предок
+    if not 1 <= len(levels) <= MAX_DEPTH:
+        raise ValueError(f"referral levels: 1..{MAX_DEPTH} values expected, got {len(levels)}")
+    row = c.execute("SELECT v FROM settings WHERE k='ref_levels'").fetchone()
+    if row is None:
+        # до графа ref_hashrate был суммой хешрейта прямых рефералов, а процент умножался отдельно
+        c.execute("UPDATE users SET ref_hashrate = ref_hashrate * ?", (LEGACY_LEVELS[0],))
+        prev = LEGACY_LEVELS
+    else:
+        prev = json.loads(row[0])
+    c.execute("DELETE FROM ref_levels")
+    c.executemany("INSERT INTO ref_levels(depth, pct) VALUES(?,?)", list(enumerate(levels, start=1)))
+    if prev != levels:
+        mode = c.execute("SELECT v FROM settings WHERE k='accrual_mode'").fetchone()
+        if mode and mode[0] == "lazy":
+            # накопленный по старым процентам бонус фиксируем до пересчёта весов у всех возможных получателей:
+            # предок, который получает вес только по новым уровням, иначе получил бы бонус с acc_mark из прошлого
+            now = int(time.time())
+            for (uid,) in c.execute("SELECT ancestor FROM ref_closure UNION "
+                                    "SELECT id FROM users WHERE ref_hashrate > 0").fetchall():
+                accrual.settle(c, uid, now)
+        accrual.recompute_ref_hashrate(c)
+        log.info("referral levels changed: %s -> %s", prev, levels)
+    c.execute("INSERT INTO settings(k,v) VALUES('ref_levels', ?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+              (json.dumps(levels),))
+    c.commit()
+
+
+# --- Reads ---
+def stats(c: sqlite3.Connection, user_id: int) -> dict:
+    row = c.execute("SELECT direct, indirect, bonus, downstream_hashrate FROM ref_stats WHERE user_id=?",
+                    (user_id,)).fetchone() or (0, 0, 0.0, 0.0)
+    return {"direct": row[0], "indirect": row[1], "bonus": row[2], "downstream_hashrate": row[3]}
+
+
+def top_referrers(c: sqlite3.Connection, limit: int = 10) -> list[tuple]:
+    # обратный обход idx_ref_stats_bonus: O(K)
+    return c.execute("SELECT s.user_id, u.username, s.direct, s.indirect, s.bonus, s.downstream_hashrate "
+                     "FROM ref_stats s LEFT JOIN users u ON u.id = s.user_id "
+                     "ORDER BY s.bonus DESC LIMIT ?", (limit,)).fetchall()
@@ -0,0 +1,510 @@
+import asyncio
+import concurrent.futures
+import logging
+import math
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import accrual
+import board
+import metrics
+
+log = logging.getLogger("miningbot.storage")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users(
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    balance REAL DEFAULT 0,
+    hashrate REAL DEFAULT 0,
+    ref_id INTEGER,
+    is_admin INTEGER DEFAULT 0,
+    wallet TEXT
+);
+CREATE TABLE IF NOT EXISTS accruals(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    amount REAL,
+    created_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS settings(
+    k TEXT PRIMARY KEY,
+    v TEXT
+);
+CREATE TABLE IF NOT EXISTS withdrawals(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    amount REAL,
+    address TEXT,
+    status TEXT DEFAULT 'pending',
+    created_at INTEGER
+);
+"""
+
+# PRAGMA-профиль: WAL позволяет читателям не ждать писателя, NORMAL в WAL не теряет целостность
+PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",  # для новой БД; существующую переводит разовый VACUUM в _ensure_auto_vacuum
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -16000,  # ~16 МБ на соединение
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+STATEMENT_CACHE = 256
+
+# LOWER(username) — чтобы поиск админа по нику шёл по индексу, а не сканом таблицы
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username));
+"""
+# на соединении писателя: id изменённых строк users собираются во временную таблицу,
+# после коммита они сбрасываются из кэша — так инвалидация покрывает любую запись, включая массовые UPDATE
+TOUCH_TRIGGERS = """
+CREATE TEMP TABLE IF NOT EXISTS touched_users(id INTEGER PRIMARY KEY);
+CREATE TEMP TRIGGER IF NOT EXISTS users_touched_upd AFTER UPDATE ON users
+BEGIN INSERT OR IGNORE INTO touched_users(id) VALUES (NEW.id); END;
+CREATE TEMP TRIGGER IF NOT EXISTS users_touched_del AFTER DELETE ON users
+BEGIN INSERT OR IGNORE INTO touched_users(id) VALUES (OLD.id); END;
+"""
+USER_CACHE_SIZE = 50000
+USER_CACHE_TTL = 300
+# если за коммит изменилось больше строк, проще сбросить кэш целиком
+CACHE_CLEAR_THRESHOLD = 1000
+
+USER_COLUMNS = "id, username, balance, hashrate, ref_id, is_admin, wallet, acc_mark, ref_hashrate"
+RATE_KEY = "rate_usdt_per_gh_per_day"
+_COMMIT_HIST = metrics.histogram("db_commit_seconds")
+
+
+def _connect(path: str, readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        c = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                            cached_statements=STATEMENT_CACHE, factory=metrics.TimedConnection)
+    else:
+        c = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE,
+                            factory=metrics.TimedConnection)
+    for k, v in PRAGMAS.items():
+        if readonly and k in ("auto_vacuum", "journal_mode"):
+            continue
+        c.execute(f"PRAGMA {k}={v}")
+    return c
+
+
+def _ensure_auto_vacuum(c: sqlite3.Connection):
+    # без auto_vacuum=INCREMENTAL ledger.compact не может отдать место ОС; у БД, созданной до этой настройки,
+    # режим меняется только полным VACUUM — один раз при старте, до запуска писателя и читателей
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    started = time.perf_counter()
+    c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    c.execute("VACUUM")
+    log.info("auto_vacuum switched to INCREMENTAL, VACUUM took %.1fs", time.perf_counter() - started)
+
+
+class UserCache:
+    # LRU + TTL поверх сырых строк users. Заполнение из читателя проверяет поколение ключа, поэтому
+    # чтение, начатое до коммита записи, не может вернуть в кэш устаревшую строку.
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL, stripes: int = 1024):
+        self.size = size
+        self.ttl = ttl
+        self._rows: OrderedDict[int, tuple[float, tuple]] = OrderedDict()
+        self._by_name: dict[str, int] = {}
+        self._gen = [0] * stripes
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def generation(self, uid: int) -> tuple[int, int]:
+        return self._epoch, self._gen[uid % len(self._gen)]
+
+    def get(self, uid: int, count: bool = True):
+        # count=False — для обращений, которые уже учтены в hits/misses вызывающим
+        with self._lock:
+            item = self._rows.get(uid)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._rows[uid]
+                if count:
+                    self.misses += 1
+                return None
+            self._rows.move_to_end(uid)
+            if count:
+                self.hits += 1
+            return item[1]
+
+    def lookup_name(self, username: str):
+        uid = self._by_name.get(username.lower())
+        row = self.get(uid, count=False) if uid is not None else None
+        # ник мог смениться: такая запись считается промахом
+        if row is None or (row[1] or "").lower() != username.lower():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row
+
+    def put(self, row: tuple, gen: tuple[int, int]):
+        uid = row[0]
+        with self._lock:
+            if gen != self.generation(uid):
+                return
+            self._rows[uid] = (time.monotonic() + self.ttl, row)
+            self._rows.move_to_end(uid)
+            if row[1]:
+                self._by_name[row[1].lower()] = uid
+            while len(self._rows) > self.size:
+                old, (_, old_row) = self._rows.popitem(last=False)
+                if old_row[1]:
+                    self._by_name.pop(old_row[1].lower(), None)
+                self.evictions += 1
+
+    def invalidate(self, uids):
+        with self._lock:
+            for uid in uids:
+                self._gen[uid % len(self._gen)] += 1
+                item = self._rows.pop(uid, None)
+                if item and item[1][1]:
+                    self._by_name.pop(item[1][1].lower(), None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._rows.clear()
+            self._by_name.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._rows), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_ratio": self.hits / total if total else 0.0}
+
+
+class StorageClosed(RuntimeError):
+    pass
+
+
+class Storage:
+    # все записи идут через один поток-писатель: задания из очереди выполняются пачкой в одной
+    # транзакции (group commit), каждое под своим SAVEPOINT; чтения — из пула read-only соединений
+    def __init__(self, path: str, admin_usernames: set[str], lazy: bool, readers: int = 4, max_batch: int = 256):
+        self.path = path
+        self.admin_usernames = admin_usernames
+        self.lazy = lazy
+        self.max_batch = max_batch
+        self._jobs: queue.Queue = queue.Queue()
+        self._readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+        self._n_readers = readers
+        self._read_pool: concurrent.futures.ThreadPoolExecutor | None = None
+        self._writer: threading.Thread | None = None
+        # после stop() новые задания не принимаются: иначе их future никогда не завершится
+        self._closed = False
+        self._submit_lock = threading.Lock()
+        self.commits = 0
+        self.jobs_done = 0
+        self.cache = UserCache()
+        metrics.gauge_fn("db_write_queue", self._jobs.qsize)
+        metrics.gauge_fn("db_commits", lambda: self.commits)
+        metrics.gauge_fn("user_cache_size", lambda: len(self.cache._rows))
+        metrics.gauge_fn("user_cache_hit_ratio", lambda: self.cache.stats()["hit_ratio"])
+
+    # --- lifecycle ---
+    def start(self, *init_fns):
+        w = _connect(self.path)
+        _ensure_auto_vacuum(w)
+        w.executescript(SCHEMA)
+        w.executescript(INDEXES)
+        w.commit()
+        # миграции и схемы подсистем выполняются до старта писателя, в обычном режиме транзакций
+        for fn in init_fns:
+            fn(w)
+            w.commit()
+        w.executescript(TOUCH_TRIGGERS)
+        w.isolation_level = None
+        for _ in range(self._n_readers):
+            self._readers.put(_connect(self.path, readonly=True))
+        self._read_pool = concurrent.futures.ThreadPoolExecutor(self._n_readers, thread_name_prefix="db-read")
+        self._writer = threading.Thread(target=self._writer_loop, args=(w,), name="db-writer", daemon=True)
+        self._closed = False
+        self._writer.start()
+
+    def stop(self):
+        with self._submit_lock:
+            self._closed = True
+            if self._writer:
+                self._jobs.put(None)
+        if self._writer:
+            self._writer.join()
+            self._writer = None
+        if self._read_pool:
+            self._read_pool.shutdown()
+            self._read_pool = None
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+    def _writer_loop(self, c: sqlite3.Connection):
+        stopping = False
+        while not stopping:
+            job = self._jobs.get()
+            if job is None:
+                break
+            if not job[3]:
+                self._run_outside_tx(c, job)
+                continue
+            batch = [job]
+            # задание вне транзакции (checkpoint и т.п.) завершает текущую пачку и выполняется после неё
+            after = None
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                if not job[3]:
+                    after = job
+                    break
+                batch.append(job)
+            self._run_batch(c, batch)
+            if after:
+                self._run_outside_tx(c, after)
+        c.close()
+
+    def _run_batch(self, c: sqlite3.Connection, batch: list):
+        results = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for fn, args, fut, _ in batch:
+                c.execute("SAVEPOINT job")
+                started = time.perf_counter()
+                try:
+                    results.append((fut, fn(c, *args), None))
+                    c.execute("RELEASE job")
+                except Exception as e:
+                    c.execute("ROLLBACK TO job")
+                    c.execute("RELEASE job")
+                    results.append((fut, None, e))
+                metrics.histogram("db_job_seconds", kind="write", job=metrics.job_name(fn)).observe(
+                    time.perf_counter() - started)
+            started = time.perf_counter()
+            c.execute("COMMIT")
+            _COMMIT_HIST.observe(time.perf_counter() - started)
+        except Exception as e:
+            log.exception("group commit of %d jobs failed", len(batch))
+            if c.in_transaction:
+                c.execute("ROLLBACK")
+            for _, _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.commits += 1
+        self.jobs_done += len(batch)
+        self._invalidate_touched(c)
+        # результаты отдаём только после коммита: awaited write всегда виден последующим чтениям
+        for fut, res, err in results:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+    def _run_outside_tx(self, c: sqlite3.Connection, job):
+        fn, args, fut, _ = job
+        started = time.perf_counter()
+        try:
+            fut.set_result(fn(c, *args))
+        except Exception as e:
+            fut.set_exception(e)
+        metrics.histogram("db_job_seconds", kind="maintenance", job=metrics.job_name(fn)).observe(
+            time.perf_counter() - started)
+        self.jobs_done += 1
+
+    def _invalidate_touched(self, c: sqlite3.Connection):
+        touched = [r[0] for r in c.execute("SELECT id FROM touched_users LIMIT ?", (CACHE_CLEAR_THRESHOLD + 1,))]
+        if not touched:
+            return
+        if len(touched) > CACHE_CLEAR_THRESHOLD:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(touched)
+        c.execute("DELETE FROM touched_users")
+
+    # --- generic access ---
+    def submit(self, fn, *args, in_tx: bool = True) -> concurrent.futures.Future:
+        fut = concurrent.futures.Future()
+        with self._submit_lock:
+            if self._closed:
+                raise StorageClosed("storage is stopped")
+            self._jobs.put((fn, args, fut, in_tx))
+        return fut
+
+    async def write(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def write_sync(self, fn, *args):
+        # для рабочих потоков (accrual), не для event loop
+        return self.submit(fn, *args).result()
+
+    def maintenance_sync(self, fn, *args):
+        # на соединении писателя, но вне транзакции: checkpoint, VACUUM и прочие PRAGMA обслуживания
+        return self.submit(fn, *args, in_tx=False).result()
+
+    def _run_read(self, fn, args):
+        if self._closed:
+            raise StorageClosed("storage is stopped")
+        c = self._readers.get()
+        started = time.perf_counter()
+        try:
+            return fn(c, *args)
+        finally:
+            self._readers.put(c)
+            metrics.histogram("db_job_seconds", kind="read", job=metrics.job_name(fn)).observe(
+                time.perf_counter() - started)
+
+    async def read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._read_pool, self._run_read, fn, args)
+
+    def read_sync(self, fn, *args):
+        return self._run_read(fn, args)
+
+    # --- users ---
+    def user_from_row(self, row):
+        if not row:
+            return None
+        u = {"id": row[0], "username": row[1], "balance": row[2], "hashrate": row[3], "ref_id": row[4], "is_admin": row[5],
+             "wallet": row[6], "ref_hashrate": row[8] or 0.0}
+        if self.lazy:
+            # баланс с учётом ещё не зафиксированного дохода
+            own, ref = accrual.lazy_pending(row[3], row[8], row[7], accrual.acc_index())
+            u["balance"] += own + ref
+        return u
+
+    def _ensure_user(self, c, user_id: int, username: str | None, ref_id: int | None):
+        if not c.execute("SELECT id FROM users WHERE id=?", (user_id,)).fetchone():
+            is_admin = 1 if (username or "").lower() in self.admin_usernames else 0
+            if self.lazy:
+                # доход копится с момента регистрации, а не с начала индекса
+                now = int(time.time())
+                c.execute("INSERT INTO users(id, username, ref_id, is_admin, acc_mark, last_accrued_at) VALUES(?,?,?,?,?,?)",
+                          (user_id, username or "", ref_id, is_admin, accrual.acc_index(now), now))
+            else:
+                c.execute("INSERT INTO users(id, username, ref_id, is_admin) VALUES(?,?,?,?)",
+                          (user_id, username or "", ref_id, is_admin))
+        else:
+            c.execute("UPDATE users SET username=? WHERE id=? AND username IS NOT ?", (username or "", user_id, username or ""))
+
+    async def ensure_user(self, user_id: int, username: str | None, ref_id: int | None = None):
+        # частый случай — юзер есть и ник не менялся: никакой записи
+        row = await self._user_row(user_id)
+        if row is not None and row[1] == (username or ""):
+            return
+        await self.write(self._ensure_user, user_id, username, ref_id)
+
+    async def _user_row(self, user_id: int, count: bool = True):
+        row = self.cache.get(user_id, count)
+        if row is not None:
+            return row
+        gen = self.cache.generation(user_id)
+        row = await self.read(lambda c: c.execute(f"SELECT {USER_COLUMNS} FROM users WHERE id=?", (user_id,)).fetchone())
+        if row is not None:
+            self.cache.put(row, gen)
+        return row
+
+    async def get_user(self, user_id: int):
+        return self.user_from_row(await self._user_row(user_id))
+
+    async def get_user_by_username(self, username: str | None):
+        if not username:
+            return None
+        row = self.cache.lookup_name(username)
+        if row is None:
+            row = await self.read(lambda c: c.execute(f"SELECT {USER_COLUMNS} FROM users WHERE LOWER(username)=LOWER(?)",
+                                                      (username,)).fetchone())
+            if row is None:
+                return None
+            # поколение берём после чтения: строка с диска актуальна на момент, когда её можно положить
+            # промах уже засчитан в lookup_name
+            return self.user_from_row(await self._user_row(row[0], count=False))
+        return self.user_from_row(row)
+
+    def _settle(self, c, user_id: int):
+        # в lazy-режиме фиксируем накопленное перед любой записью в balance
+        if self.lazy:
+            accrual.settle(c, user_id)
+
+    async def set_wallet(self, user_id: int, address: str):
+        await self.write(lambda c: c.execute("UPDATE users SET wallet=? WHERE id=?", (address, user_id)))
+
+    async def grant(self, user_id: int, amount: float):
+        # nan/inf записали бы в balance NULL
+        if not math.isfinite(amount):
+            raise ValueError(f"bad amount: {amount!r}")
+        def tx(c):
+            self._settle(c, user_id)
+            c.execute("UPDATE users SET balance = balance + ? WHERE id=?", (amount, user_id))
+        await self.write(tx)
+
+    # --- withdrawals ---
+    async def create_withdrawal(self, user_id: int, amount: float, address: str, chain: str) -> tuple[bool, float]:
+        # проверка баланса и вставка заявки — в одной транзакции писателя
+        def tx(c):
+            self._settle(c, user_id)
+            bal = c.execute("SELECT balance FROM users WHERE id=?", (user_id,)).fetchone()[0]
+            # NaN проходит любые сравнения, поэтому конечность проверяется явно
+            if not math.isfinite(amount) or amount <= 0 or amount > bal:
+                return False, bal
+            c.execute("INSERT INTO withdrawals(user_id, amount, address, chain, created_at) VALUES(?,?,?,?,?)",
+                      (user_id, amount, address, chain, int(time.time())))
+            return True, bal
+        return await self.write(tx)
+
+    async def pending_withdrawals_page(self, cursor: int = 0, forward: bool = True, limit: int = 10):
+        return await self.read(board.pending_withdrawals_page, cursor, forward, limit)
+
+    async def approve_withdrawal(self, wid: int):
+        # одобрение: списываем баланс и помечаем approved; при нехватке средств заявка остаётся pending
+        def tx(c):
+            row = c.execute("SELECT user_id, amount FROM withdrawals WHERE id=? AND status='pending'", (wid,)).fetchone()
+            if not row:
+                return None
+            uid, amt = row
+            self._settle(c, uid)
+            if c.execute("UPDATE users SET balance = balance - ? WHERE id=? AND balance >= ?", (amt, uid, amt)).rowcount != 1:
+                return uid, amt, False
+            c.execute("UPDATE withdrawals SET status='approved' WHERE id=?", (wid,))
+            return uid, amt, True
+        return await self.write(tx)
+
+    async def reject_withdrawal(self, wid: int) -> bool:
+        # только pending: одобренную или ушедшую в пакетную выплату заявку старая кнопка не трогает
+        return await self.write(lambda c: c.execute("UPDATE withdrawals SET status='rejected' WHERE id=? AND status='pending'",
+                                                    (wid,)).rowcount == 1)
+
+    # --- admin / settings ---
+    async def counter(self, name: str) -> int:
+        return await self.read(board.counter, name)
+
+    async def top_balances(self, limit: int = 10):
+        return await self.read(board.top_balances, limit, self.lazy)
+
+    async def users_page(self, cursor: int = 0, forward: bool = True, limit: int = 20):
+        return await self.read(board.users_page, cursor, forward, limit)
+
+    async def accruals_page(self, cursor: int = board.NEWEST, forward: bool = True, limit: int = 20):
+        return await self.read(board.accruals_page, cursor, forward, limit)
+
+    def get_rate_sync(self, default: float) -> float:
+        row = self.read_sync(lambda c: c.execute("SELECT v FROM settings WHERE k=?", (RATE_KEY,)).fetchone())
+        return float(row[0]) if row else default
+
+    async def get_rate(self, default: float) -> float:
+        row = await self.read(lambda c: c.execute("SELECT v FROM settings WHERE k=?", (RATE_KEY,)).fetchone())
+        return float(row[0]) if row else default
+
+    async def set_rate(self, val: float):
+        def tx(c):
+            c.execute("INSERT INTO settings(k,v) VALUES(?, ?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (RATE_KEY, str(val)))
+            accrual.add_rate_segment(c, val)
+        await self.write(tx)